@@ -4,9 +4,13 @@
 
 pydoc packet.capfile.core > ./doc/packet.capfile.core
 pydoc packet.capfile.pcap > ./doc/packet.capfile.pcap
+pydoc packet.capfile.pcapng > ./doc/packet.capfile.pcapng
+pydoc packet.capfile.detect > ./doc/packet.capfile.detect
+pydoc packet.capfile.index > ./doc/packet.capfile.index
 
 pydoc packet.identity.arp > ./doc/packet.identity.arp
 pydoc packet.identity.core > ./doc/packet.identity.core
+pydoc packet.identity.compact > ./doc/packet.identity.compact
 pydoc packet.identity.eth > ./doc/packet.identity.eth
 pydoc packet.identity.icmp6 > ./doc/packet.identity.icmp6
 pydoc packet.identity.icmp > ./doc/packet.identity.icmp
@@ -18,9 +22,18 @@ pydoc packet.identity.udp > ./doc/packet.identity.udp
 
 pydoc packet.pipeline.merge > ./doc/packet.pipeline.merge
 pydoc packet.pipeline.filter > ./doc/packet.pipeline.filter
+pydoc packet.pipeline.expression > ./doc/packet.pipeline.expression
+pydoc packet.pipeline.bpf > ./doc/packet.pipeline.bpf
 pydoc packet.pipeline.identify > ./doc/packet.pipeline.identify
+pydoc packet.pipeline.parallel > ./doc/packet.pipeline.parallel
+pydoc packet.pipeline.cascade > ./doc/packet.pipeline.cascade
+pydoc packet.pipeline.prefetch > ./doc/packet.pipeline.prefetch
+pydoc packet.pipeline.reorder > ./doc/packet.pipeline.reorder
+pydoc packet.pipeline.sort > ./doc/packet.pipeline.sort
+pydoc packet.pipeline.dedup > ./doc/packet.pipeline.dedup
 
 pydoc packet.common > ./doc/packet.common
 pydoc packet.memorymap > ./doc/packet.memorymap
+pydoc packet.radix > ./doc/packet.radix
 
 
@@ -1,8 +1,20 @@
 """
 core:
  - Abstract classes for packet capture file readers/writers.
+ - BufferedPacketWriter, a base class for writers that batch their output.
 """
 
+import time
+
+from ..common import PacketBatch
+
+
+# Number of packets read per call by PacketReader.packets
+PACKET_BATCH_SIZE = 1024
+
+# Default amount of data a BufferedPacketWriter collects before writing.
+PACKET_WRITE_BUFFER_SIZE = 2**20
+
 
 class PacketIOError(Exception):
     """Exception raised by Packet(Reader|Writer)s."""
@@ -13,7 +25,9 @@ class PacketReader:
     """
     Abstract class for packet readers.
     Implementatons must provide the 'read_packet' method.
-    This class implements the __next__ method based on read_packet()
+    This class implements the __next__ method based on read_packet(),
+    and default read_packets/read_batch methods, which implementations may
+    override with faster bulk readers.
     """
 
     def __iter__(self):
@@ -42,6 +56,47 @@ class PacketReader:
         """
         raise NotImplementedError("read_packet not implemented.")
 
+    def read_packets(self, count):
+        """
+        Reads up to 'count' packets, returning them in a list.
+        An empty list is returned if there are no packets left.
+        This default implementation simply calls read_packet repeatedly.
+        """
+        packets = []
+        while len(packets) < count:
+            pkt = self.read_packet()
+            if pkt is None:
+                break
+            packets.append(pkt)
+        return packets
+
+    def read_batch(self, count):
+        """
+        Reads up to 'count' packets, returning them in a PacketBatch.
+        An empty batch is returned if there are no packets left.
+        This default implementation copies the packets from read_packets.
+        """
+        batch = PacketBatch()
+        for pkt in self.read_packets(count):
+            batch.append_packet(pkt)
+        return batch
+
+    def packets(self, count=PACKET_BATCH_SIZE):
+        """
+        Generator method, yields every remaining packet,
+        reading them 'count' at a time with read_packets.
+        Like __next__, this stops on a PacketIOError.
+        """
+        while True:
+            try:
+                batch = self.read_packets(count)
+            except PacketIOError:
+                return
+
+            if not batch:
+                return
+            yield from batch
+
     def close(self):
         """Abstract method close. Should close filesystem resources."""
         raise NotImplementedError("close not implemented.")
@@ -60,6 +115,80 @@ class PacketWriter:
         """
         raise NotImplementedError("write_packet not implemented.")
 
+    def write_packets(self, packets):
+        """
+        Writes every packet in an iterable.
+        This default implementation simply calls write_packet repeatedly.
+        """
+        for packet in packets:
+            self.write_packet(packet)
+
+    def flush(self):
+        """Writes out any buffered data. The default implementation does nothing."""
+        return
+
     def close(self):
         """Abstract method close. Should cleanup any filesystem resources."""
         raise NotImplementedError("close not implemented.")
+
+
+class BufferedPacketWriter(PacketWriter):
+    """
+    Abstract class for packet writers that coalesce records into large writes.
+    Implementations must provide the 'pack_packet' method, which appends
+    the encoded packet to a bytearray.
+    The buffer is written out and the stream flushed when it holds at least
+    'buffer_size' bytes, when 'flush_interval' seconds have passed since
+    the last flush (checked as packets are written), or on flush/close.
+    A buffer_size of 0 writes and flushes every packet, for live pipelines.
+    """
+
+    def __init__(self, stream, buffer_size=PACKET_WRITE_BUFFER_SIZE, flush_interval=None):
+        """Sets up the buffer and flush policy."""
+        self.stream = stream
+        self.buffer = bytearray()
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.flush_time = time.monotonic()
+
+    def pack_packet(self, packet, buf):
+        """
+        Abstract method pack_packet.
+        Should append the record for the 'Packet' object to the bytearray buf.
+        """
+        raise NotImplementedError("pack_packet not implemented.")
+
+    def write_packet(self, packet):
+        """Adds a packet to the buffer, flushing if the flush policy says so."""
+        self.pack_packet(packet, self.buffer)
+        self.flush_if_due()
+
+    def write_packets(self, packets):
+        """Adds every packet in an iterable to the buffer, flushing as needed."""
+        buf = self.buffer
+        for packet in packets:
+            self.pack_packet(packet, buf)
+            if len(buf) >= self.buffer_size:
+                self.flush()
+        self.flush_if_due()
+
+    def flush_if_due(self):
+        """Flushes if the buffer is full or the flush interval has passed."""
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+        elif self.flush_interval is not None and \
+            time.monotonic() - self.flush_time >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Writes out the buffer and flushes the stream."""
+        if len(self.buffer) > 0:
+            self.stream.write(self.buffer)
+            del self.buffer[:]
+        self.stream.flush()
+        self.flush_time = time.monotonic()
+
+    def close(self):
+        """Flushes any buffered data and closes the stream."""
+        self.flush()
+        self.stream.close()
@@ -0,0 +1,24 @@
+from . import pcap
+from . import pcapng
+
+"""
+detect: Chooses a reader for a capture file based on its magic number.
+"""
+
+
+def open_reader(fstream, use_mmap=True):
+    """
+    Reads the magic number from a stream and creates a suitable reader.
+    pcapng files are read with a PcapngReader; everything else is passed
+    to pcap.pcap_open_reader, which raises PcapFormatError on invalid magic.
+    """
+    magic = fstream.read(4)
+
+    if magic == pcapng.PCAPNG_MAGIC:
+        return pcapng.PcapngReader(fstream, magic)
+    return pcap.pcap_open_reader(fstream, magic, use_mmap)
+
+
+def is_nanosecond(reader):
+    """Returns True if a reader is for a nanosecond resolution pcap file."""
+    return isinstance(reader, pcap.PcapReader) and reader.timescale == 10**9
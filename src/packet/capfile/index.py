@@ -0,0 +1,175 @@
+import os
+import array
+import bisect
+import struct
+
+from .core import PacketIOError
+
+"""
+index: Sidecar offset/timestamp indexes for pcap files.
+An index holds the file offset and time of every Nth record of a capture,
+which allows a reader to seek close to a given time with a binary search,
+rather than reading the capture from the start.
+Captures are assumed to be in chronological order.
+"""
+
+# Index file layout (little-endian):
+#
+# magic           4 bytes, "PCIX"
+# version         uint32
+# interval        uint32, records between samples
+# file_size       uint64, size of the capture when indexed
+# count           uint64, number of samples
+# samples         count * (uint64 offset, int64 nanoseconds)
+
+PCAP_INDEX_MAGIC = b"PCIX"
+PCAP_INDEX_VERSION = 1
+PCAP_INDEX_HEADER = struct.Struct("<IIQQ")
+
+# Default number of records between samples.
+PCAP_INDEX_INTERVAL = 1000
+
+# Suffix added to a capture's path to give its sidecar index path.
+PCAP_INDEX_SUFFIX = ".idx"
+
+
+class PcapIndexError(PacketIOError):
+    """Exception raised when an index file is invalid."""
+    pass
+
+
+def index_path(capture_path):
+    """Returns the path of the sidecar index for a capture."""
+    return capture_path + PCAP_INDEX_SUFFIX
+
+
+class PcapIndex:
+    """
+    Sampled index of a pcap file.
+     - interval: Number of records between samples.
+     - file_size: Size of the capture file when it was indexed.
+     - offsets: File offsets of the sampled records.
+     - timestamps: Times of the sampled records, in integer nanoseconds.
+    """
+    __slots__ = {"interval", "file_size", "offsets", "timestamps"}
+
+    def __init__(self, interval=PCAP_INDEX_INTERVAL, file_size=0):
+        self.interval = interval
+        self.file_size = file_size
+        self.offsets = array.array("Q")
+        self.timestamps = array.array("q")
+
+    def __len__(self):
+        """Returns the number of samples."""
+        return len(self.offsets)
+
+    def lookup(self, timestamp):
+        """
+        Returns the offset of the last sampled record older than timestamp
+        (in nanoseconds), where a scan for the first record at or after
+        timestamp should start. Returns None if the index is empty.
+        """
+        if len(self.offsets) == 0:
+            return None
+
+        # First sample not older than the timestamp. Records equal to the
+        # timestamp may precede it, so start from the sample before.
+        i = bisect.bisect_left(self.timestamps, timestamp)
+        return self.offsets[max(0, i - 1)]
+
+    def save(self, stream):
+        """Writes the index to a binary stream."""
+        stream.write(PCAP_INDEX_MAGIC)
+        stream.write(PCAP_INDEX_HEADER.pack(
+            PCAP_INDEX_VERSION, self.interval, self.file_size, len(self.offsets)))
+
+        # Interleave offsets and timestamps into (offset, timestamp) pairs.
+        samples = struct.Struct("<Qq")
+        stream.write(b"".join(samples.pack(offset, timestamp)
+                              for offset, timestamp in zip(self.offsets, self.timestamps)))
+
+    @staticmethod
+    def load(stream):
+        """Reads an index from a binary stream."""
+        if stream.read(4) != PCAP_INDEX_MAGIC:
+            raise PcapIndexError("Not a pcap index.")
+
+        header = stream.read(PCAP_INDEX_HEADER.size)
+        if len(header) < PCAP_INDEX_HEADER.size:
+            raise PcapIndexError("Index truncated.")
+
+        version, interval, file_size, count = PCAP_INDEX_HEADER.unpack(header)
+        if version != PCAP_INDEX_VERSION:
+            raise PcapIndexError("Unsupported index version {0}".format(version))
+
+        data = stream.read(count * 16)
+        if len(data) < count * 16:
+            raise PcapIndexError("Index truncated.")
+
+        index = PcapIndex(interval, file_size)
+        for offset, timestamp in struct.iter_unpack("<Qq", data):
+            index.offsets.append(offset)
+            index.timestamps.append(timestamp)
+        return index
+
+
+def build_index(reader, interval=PCAP_INDEX_INTERVAL):
+    """
+    Builds an index of a pcap reader, from the reader's current position.
+    Only record headers are read; record data is skipped.
+    The reader is left at EOF.
+    """
+    index = PcapIndex(interval)
+
+    count = 0
+    while True:
+        offset = reader.tell()
+        packet_header = reader.skip_packet()
+        if packet_header is None:
+            break
+
+        if count % interval == 0:
+            index.offsets.append(offset)
+            index.timestamps.append(reader.record_timestamp(packet_header))
+        count += 1
+
+    index.file_size = reader.tell()
+    return index
+
+
+def seek_time(reader, index, timestamp):
+    """
+    Moves a pcap reader to the first record at or after timestamp
+    (in nanoseconds), or to EOF if there is none.
+    If index is None, the scan starts from the reader's current position.
+    """
+    if index is not None:
+        offset = index.lookup(timestamp)
+        if offset is not None:
+            reader.seek(offset)
+
+    while True:
+        offset = reader.tell()
+        packet_header = reader.skip_packet()
+        if packet_header is None:
+            return
+
+        if reader.record_timestamp(packet_header) >= timestamp:
+            reader.seek(offset)
+            return
+
+
+def load_sidecar(capture_path):
+    """
+    Loads the sidecar index for a capture, if there is one and it is
+    up to date (its recorded file size matches the capture). Returns None otherwise.
+    """
+    try:
+        with open(index_path(capture_path), "rb") as index_file:
+            index = PcapIndex.load(index_file)
+    except (FileNotFoundError, PcapIndexError):
+        return None
+
+    if index.file_size != os.path.getsize(capture_path):
+        return None
+    return index
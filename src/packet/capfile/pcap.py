@@ -1,7 +1,11 @@
+import os
+import mmap
+import stat
 import struct
 
-from ..common import Packet
-from .core import PacketReader, PacketWriter, PacketIOError
+from ..common import Packet, PacketBatch
+from .core import PacketReader, BufferedPacketWriter, PacketIOError
+from .core import PACKET_WRITE_BUFFER_SIZE
 
 """
 pcap: Contains classes for reading and writing to pcap files.
@@ -47,6 +51,17 @@ PCAP_BE_PKT_HDR = struct.Struct(">IIII")
 PCAP_MAJOR_VER = 2
 PCAP_MINOR_VER = 4
 
+# Amount of data PcapReader.read_records asks the stream for at a time.
+PCAP_READ_SIZE = 2**20
+
+# Record boundary resynchronisation (PcapMmapReader.resync):
+# Number of consecutive valid records needed to accept a candidate offset.
+PCAP_RESYNC_CHAIN = 4
+# Largest distance, in seconds, of a record from the first record's time.
+PCAP_RESYNC_TIME_WINDOW = 366 * 24 * 60 * 60
+# Largest record size accepted if the file header has no snaplen.
+PCAP_RESYNC_MAX_SNAPLEN = 262144
+
 
 # Magic number: [a1 b2 c3 d4] OR [a1 b2 3c 4d] if file has nanosecond
 # resolution. This is stored in the same endianess as the rest of the
@@ -76,7 +91,7 @@ def pcap_magic_resolve(magic):
         if magic.startswith(b"\xd4\xc3"):
             # Regular (microsecond) little-endian pcap file
             timescale = 10**6
-        elif magic.startswith(b"\xd4\xc3"):
+        elif magic.startswith(b"\x4d\x3c"):
             # Nanosecond little-endian pcap file
             timescale = 10**9
         else:
@@ -130,12 +145,30 @@ class PcapReader(PacketReader):
             self.snaplen,\
             self.network = global_header_struct.unpack(global_header_data)
 
+        # Data read ahead by read_records, and the position of the next record in it.
+        self.buffer = bytearray()
+        self.buffer_pos = 0
+
+    def read_buffered(self, size):
+        """
+        Reads up to size bytes, taking any data read ahead by read_records
+        first and the remainder from the stream.
+        """
+        if self.buffer_pos == len(self.buffer):
+            return self.stream.read(size)
+
+        data = self.buffer[self.buffer_pos:self.buffer_pos + size]
+        self.buffer_pos += len(data)
+        if len(data) < size:
+            data += self.stream.read(size - len(data))
+        return data
+
     def read_packet(self):
         """
         Reads a packet record header and it's data from the stream.
         Returns a Packet object, or None on EOF.
         """
-        packet_header_data = self.stream.read(self.packet_header_struct.size)
+        packet_header_data = self.read_buffered(self.packet_header_struct.size)
         # Test for EOF or truncation
         if packet_header_data == b"":
             # EOF
@@ -145,28 +178,337 @@ class PcapReader(PacketReader):
             raise PcapFormatError("Stream truncated.")
 
         packet_header = self.packet_header_struct.unpack(packet_header_data)
-        packet_data = self.stream.read(packet_header[2])
+        packet_data = self.read_buffered(packet_header[2])
+
+        return self.make_packet(packet_header, packet_data)
+
+    def read_records(self, count):
+        """
+        Reads up to 'count' records from the stream, returning a list of
+        (record header tuple, data) tuples. Data are memoryviews of the block read.
+        Data is read in large blocks (PCAP_READ_SIZE) and every complete record
+        in a block is parsed in one go.
+        Records straddling the end of a block are kept for the next read.
+        To avoid stalling live streams, this only waits for more data when
+        no complete record is available; in that case the returned list may
+        hold less than 'count' records. An empty list is returned on EOF.
+        """
+        # Read1 returns whatever is available, rather than waiting for 'size' bytes.
+        read = getattr(self.stream, "read1", self.stream.read)
+        header_struct = self.packet_header_struct
+        header_size = header_struct.size
+
+        buf = self.buffer
+        pos = self.buffer_pos
+        view = memoryview(buf)
+        records = []
+        while True:
+            end = len(buf)
+            needed = header_size
+
+            # Parse every complete record in the buffer.
+            while len(records) < count and pos + header_size <= end:
+                packet_header = header_struct.unpack_from(buf, pos)
+                data_start = pos + header_size
+                data_end = data_start + packet_header[2]
+                if data_end > end:
+                    needed = data_end - pos
+                    break
+                records.append((packet_header, view[data_start:data_end]))
+                pos = data_end
+
+            if records or count <= 0:
+                break
+
+            # No complete record is buffered, read more.
+            chunk = read(max(PCAP_READ_SIZE, needed - (end - pos)))
+            if chunk == b"":
+                if pos != end:
+                    raise PcapFormatError("Stream truncated.")
+                # EOF
+                break
+
+            # Start a new buffer, the old one may still be referenced by packets.
+            view.release()
+            buf = buf[pos:]
+            buf += chunk
+            pos = 0
+            view = memoryview(buf)
+
+        self.buffer = buf
+        self.buffer_pos = pos
+        return records
+
+    def read_packets(self, count):
+        """
+        Reads up to 'count' packets, returning them in a list.
+        Packets are parsed in bulk, see read_records.
+        An empty list is returned on EOF.
+        """
+        make_packet = self.make_packet
+        return [make_packet(packet_header, data)
+                for packet_header, data in self.read_records(count)]
+
+    def read_batch(self, count):
+        """
+        Reads up to 'count' packets, returning them in a PacketBatch.
+        No Packet objects are created. An empty batch is returned on EOF.
+        """
+        batch = PacketBatch()
+        record_timestamp = self.record_timestamp
+        for packet_header, data in self.read_records(count):
+            batch.append(record_timestamp(packet_header), self.network, packet_header[3], data)
+        return batch
+
+    def skip_packet(self):
+        """
+        Reads a packet record header and skips over it's data.
+        Returns the record header tuple, or None on EOF.
+        """
+        packet_header_data = self.read_buffered(self.packet_header_struct.size)
+        if packet_header_data == b"":
+            # EOF
+            return None
+        elif len(packet_header_data) < self.packet_header_struct.size:
+            # Truncation
+            raise PcapFormatError("Stream truncated.")
+
+        packet_header = self.packet_header_struct.unpack(packet_header_data)
 
-        # (unixtime, linktype, origlen, data)
-        packet = Packet(
-            packet_header[0] + self.thiszone + (packet_header[1] / self.timescale),
+        # Skip data held in the buffer, then seek past the rest.
+        buffered = min(packet_header[2], len(self.buffer) - self.buffer_pos)
+        self.buffer_pos += buffered
+        if packet_header[2] > buffered:
+            self.stream.seek(packet_header[2] - buffered, 1)
+
+        return packet_header
+
+    def tell(self):
+        """Returns the file offset of the next record."""
+        return self.stream.tell() - (len(self.buffer) - self.buffer_pos)
+
+    def seek(self, offset):
+        """Moves to the record at the given file offset. The stream must be seekable."""
+        self.stream.seek(offset)
+        self.buffer = bytearray()
+        self.buffer_pos = 0
+
+    def record_timestamp(self, packet_header):
+        """Returns the time of a record header tuple, as integer nanoseconds since the epoch."""
+        return (packet_header[0] + self.thiszone) * 10**9 + \
+            packet_header[1] * (10**9 // self.timescale)
+
+    def make_packet(self, packet_header, packet_data):
+        """Creates a Packet object from a record header tuple and its data."""
+        # (timestamp, linktype, origlen, data)
+        return Packet(
+            self.record_timestamp(packet_header),
             self.network,
             packet_header[3],
             packet_data)
 
-        return packet
-
     def close(self):
         """Closes the stream."""
         self.stream.close()
 
 
-class PcapWriter(PacketWriter):
-    """PcapWriter: writer for pcap files."""
+class PcapMmapReader(PcapReader):
+    """
+    PcapMmapReader: zero-copy reader for pcap files on disk.
+    The file is memory mapped, and packets are handed out with their data
+    being a memoryview of the mapping, so record data is never copied.
+    The mapping is private (copy-on-write), stages that alter packet data
+    (e.g. replace_hosts) cause the kernel to copy only the pages touched,
+    and the file itself is never modified.
+    """
+
+    def __init__(self, fstream, magic=None):
+        """
+        Creates a PcapMmapReader from an open file.
+        Arguments are as for PcapReader, but the stream must have a fileno.
+        """
+        super().__init__(fstream, magic)
+
+        # Map the whole file. Records start where the global header ended.
+        self.mapping = mmap.mmap(fstream.fileno(), 0, access=mmap.ACCESS_COPY)
+        self.view = memoryview(self.mapping)
+        self.position = fstream.tell()
+
+        # Offset of the first record.
+        self.data_offset = self.position
+
+    def read_packet(self):
+        """
+        Reads a packet record header and it's data from the mapping.
+        Returns a Packet object, or None on EOF.
+        """
+        size = len(self.view)
+        if self.position == size:
+            # EOF
+            return None
+
+        data_start = self.position + self.packet_header_struct.size
+        if data_start > size:
+            raise PcapFormatError("Stream truncated.")
+
+        packet_header = self.packet_header_struct.unpack_from(
+            self.view, self.position)
+
+        data_end = data_start + packet_header[2]
+        if data_end > size:
+            raise PcapFormatError("Stream truncated.")
+
+        self.position = data_end
+        return self.make_packet(packet_header, self.view[data_start:data_end])
+
+    def skip_packet(self):
+        """
+        Reads a packet record header and skips over it's data.
+        Returns the record header tuple, or None on EOF.
+        """
+        size = len(self.view)
+        if self.position == size:
+            # EOF
+            return None
+
+        data_start = self.position + self.packet_header_struct.size
+        if data_start > size:
+            raise PcapFormatError("Stream truncated.")
+
+        packet_header = self.packet_header_struct.unpack_from(
+            self.view, self.position)
+        self.position = min(size, data_start + packet_header[2])
+        return packet_header
+
+    def tell(self):
+        """Returns the file offset of the next record."""
+        return self.position
+
+    def record_valid(self, offset, first_sec, max_len):
+        """
+        Tests whether the bytes at offset look like a record header.
+        Returns the offset of the following record, or None.
+        """
+        end = offset + self.packet_header_struct.size
+        if end > len(self.view):
+            return None
+
+        ts_sec, ts_frac, incl_len, orig_len = \
+            self.packet_header_struct.unpack_from(self.view, offset)
+
+        if incl_len > max_len or incl_len > orig_len or ts_frac >= self.timescale or \
+            abs(ts_sec - first_sec) > PCAP_RESYNC_TIME_WINDOW or end + incl_len > len(self.view):
+            return None
+        return end + incl_len
+
+    def resync(self, offset):
+        """
+        Finds the first record boundary at or after an arbitrary file offset.
+        A candidate offset is accepted if it, and the records chained after it
+        (up to PCAP_RESYNC_CHAIN, or the end of the file) have plausible headers:
+        captured length within the snaplen and no more than the original length,
+        a valid sub-second part, and a time near that of the first record.
+        Returns the offset found, or the file size if there is none.
+        """
+        size = len(self.view)
+        first = self.data_offset
+        if offset <= first:
+            return first
+        if first + self.packet_header_struct.size > size:
+            return size
+
+        first_sec = self.packet_header_struct.unpack_from(self.view, first)[0]
+        max_len = self.snaplen if self.snaplen > 0 else PCAP_RESYNC_MAX_SNAPLEN
+
+        for candidate in range(offset, size):
+            following = candidate
+            for _ in range(PCAP_RESYNC_CHAIN):
+                following = self.record_valid(following, first_sec, max_len)
+                if following is None or following == size:
+                    break
+            if following is not None:
+                return candidate
+
+        return size
+
+    def seek(self, offset):
+        """Moves to the record at the given file offset."""
+        self.position = offset
+
+    def read_records(self, count):
+        """
+        Reads up to 'count' records from the mapping, returning a list of
+        (record header tuple, data) tuples. Data are memoryviews of the mapping.
+        An empty list is returned on EOF.
+        """
+        header_struct = self.packet_header_struct
+        header_size = header_struct.size
+        view = self.view
+        size = len(view)
+        pos = self.position
+
+        records = []
+        while len(records) < count and pos != size:
+            data_start = pos + header_size
+            if data_start > size:
+                break
+            packet_header = header_struct.unpack_from(view, pos)
+            data_end = data_start + packet_header[2]
+            if data_end > size:
+                break
+            records.append((packet_header, view[data_start:data_end]))
+            pos = data_end
+
+        self.position = pos
+        if not records and pos != size:
+            raise PcapFormatError("Stream truncated.")
+        return records
+
+    def close(self):
+        """Releases the mapping (if no packets still refer to it) and closes the stream."""
+        self.view.release()
+        try:
+            self.mapping.close()
+        except BufferError:
+            # Packets still hold views of the mapping,
+            # it is unmapped once they are gone.
+            pass
+        self.stream.close()
+
+
+def pcap_open_reader(fstream, magic=None, use_mmap=True):
+    """
+    Creates a reader suitable for the given stream.
+    Regular, non-empty files are read with a PcapMmapReader,
+    anything else (pipes, sockets, etc.) with a PcapReader.
+    If use_mmap is False, a PcapReader is always used. A mapping holds
+    a duplicate of the file descriptor, so this halves the descriptors used.
+    """
+    if not use_mmap:
+        return PcapReader(fstream, magic)
+
+    try:
+        status = os.fstat(fstream.fileno())
+        mappable = stat.S_ISREG(status.st_mode) and status.st_size > 0
+    except (AttributeError, OSError, ValueError):
+        # io.UnsupportedOperation is both an OSError and a ValueError.
+        mappable = False
+
+    if mappable:
+        return PcapMmapReader(fstream, magic)
+    return PcapReader(fstream, magic)
+
+
+class PcapWriter(BufferedPacketWriter):
+    """
+    PcapWriter: writer for pcap files.
+    Records are buffered, see BufferedPacketWriter for the flush policy.
+    """
 
-    def __init__(self, stream, magic=PCAP_LE_REGULAR, thiszone=0, snaplen=65535, network=1):
+    def __init__(self, stream, magic=PCAP_LE_REGULAR, thiszone=0, snaplen=65535, network=1,
+                 buffer_size=PACKET_WRITE_BUFFER_SIZE, flush_interval=None):
         """Setup a new PcapWriter object, and write a global header to the stream."""
-        self.stream = stream
+        super().__init__(stream, buffer_size, flush_interval)
         self.thiszone = thiszone
         self.snaplen = snaplen
         self.network = network
@@ -175,29 +517,25 @@ class PcapWriter(PacketWriter):
         global_header_struct, self.packet_header_struct, self.timescale\
             = pcap_magic_resolve(magic)
 
-        self.stream.write(magic)
-        self.stream.write(global_header_struct.pack(
+        self.buffer += magic
+        self.buffer += global_header_struct.pack(
             PCAP_MAJOR_VER, PCAP_MINOR_VER, 0, 0,
-            self.snaplen, self.network))
+            self.snaplen, self.network)
+        self.flush_if_due()
 
-    def write_packet(self, packet):
-        """Writes a packet record header and data to the stream."""
+    def pack_packet(self, packet, buf):
+        """Appends a packet record header and data to buf."""
         if packet.linktype != self.network:
             raise PcapFormatError("Packet cannot be represented (wrong linktype)")
 
         # Truncate packet.data to the snaplen limit, if needed.
         maxlen = min(self.snaplen, len(packet.data))
 
-        # Build packet record header.
-        packet_header = self.packet_header_struct.pack(
-            int(packet.unixtime) - self.thiszone,
-            round((packet.unixtime % 1.0) * self.timescale),
+        # Build packet record header, sub-second part truncated to the timescale.
+        seconds, nanoseconds = divmod(packet.timestamp, 10**9)
+        buf += self.packet_header_struct.pack(
+            seconds - self.thiszone,
+            nanoseconds // (10**9 // self.timescale),
             maxlen, packet.origlen)
-
-        self.stream.write(packet_header)
-        self.stream.write(packet.data[:maxlen])
-        self.stream.flush()
-
-    def close(self):
-        """Closes the stream."""
-        self.stream.close()
+        # Slice a memoryview, so the data is only copied into the buffer.
+        buf += memoryview(packet.data)[:maxlen]
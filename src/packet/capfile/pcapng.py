@@ -0,0 +1,342 @@
+import struct
+
+from ..common import Packet
+from .core import PacketReader, BufferedPacketWriter, PacketIOError
+from .core import PACKET_WRITE_BUFFER_SIZE
+
+"""
+pcapng: Contains classes for reading and writing to pcapng files.
+"""
+
+# A pcapng file is a sequence of blocks, all of which have the form:
+#
+#  0                   1                   2                   3
+#  0 1 2 3 4 5 6 7 8 9 0 1 2 3 4 5 6 7 8 9 0 1 2 3 4 5 6 7 8 9 0 1
+# +---------------------------------------------------------------+
+# |                          Block Type                           |
+# +---------------------------------------------------------------+
+# |                      Block Total Length                       |
+# +---------------------------------------------------------------+
+# /                          Block Body                           /
+# /          /* variable length, aligned to 32 bits */            /
+# +---------------------------------------------------------------+
+# |                      Block Total Length                       |
+# +---------------------------------------------------------------+
+#
+# The file starts with a Section Header Block, the byte order magic in it
+# gives the endianness of every block in the section. A file may contain
+# several sections. Interface Description Blocks describe the linktype,
+# snaplen and timestamp resolution of an interface; packets (Enhanced Packet
+# Blocks) refer to interfaces by their index within the section.
+
+# Block types.
+PCAPNG_BLOCK_SHB = 0x0A0D0D0A
+PCAPNG_BLOCK_IDB = 0x00000001
+PCAPNG_BLOCK_SPB = 0x00000003
+PCAPNG_BLOCK_EPB = 0x00000006
+
+# Option codes.
+PCAPNG_OPT_ENDOFOPT = 0
+PCAPNG_OPT_IF_TSRESOL = 9
+PCAPNG_OPT_IF_TSOFFSET = 14
+
+# Literal definitions for the first four bytes of a file (the SHB block type),
+# and the two possible byte order magic permutations.
+PCAPNG_MAGIC = b"\x0a\x0d\x0d\x0a"
+PCAPNG_LE_BYTE_ORDER = b"\x4d\x3c\x2b\x1a"
+PCAPNG_BE_BYTE_ORDER = b"\x1a\x2b\x3c\x4d"
+
+# Major/minor versions of the pcapng file format.
+PCAPNG_MAJOR_VER = 1
+PCAPNG_MINOR_VER = 0
+
+# Default timestamp resolution, as an if_tsresol value (10^-6 seconds).
+PCAPNG_DEFAULT_TSRESOL = 6
+
+# Block header (type, total length) and trailer (total length) size.
+PCAPNG_BLOCK_HEADER_SIZE = 8
+PCAPNG_BLOCK_TRAILER_SIZE = 4
+
+
+def pcapng_byte_order_resolve(byte_order):
+    """
+    Function that resolves pcapng's byte order magic into a struct prefix.
+    Raises PcapngFormatError on invalid magic.
+    """
+    if byte_order == PCAPNG_LE_BYTE_ORDER:
+        return "<"
+    elif byte_order == PCAPNG_BE_BYTE_ORDER:
+        return ">"
+    else:
+        raise PcapngFormatError("Invalid byte order magic {0}".format(byte_order))
+
+
+def pcapng_tsresol_resolve(tsresol):
+    """
+    Converts an if_tsresol option value to the number of timestamp units per second.
+    If the most significant bit is set, the resolution is a negative power of 2,
+    otherwise it is a negative power of 10.
+    """
+    if tsresol & 0x80:
+        return 2**(tsresol & 0x7F)
+    return 10**tsresol
+
+
+def pcapng_pad(length):
+    """Returns length, rounded up to a multiple of 4."""
+    return (length + 3) & ~3
+
+
+class PcapngFormatError(PacketIOError):
+    """Exception raised when a file format error occurs."""
+    pass
+
+
+class PcapngInterface:
+    """Properties of an interface, as given by an Interface Description Block."""
+    __slots__ = {"linktype", "snaplen", "timescale", "tsoffset"}
+
+    def __init__(self, linktype, snaplen, timescale=10**PCAPNG_DEFAULT_TSRESOL, tsoffset=0):
+        self.linktype = linktype
+        self.snaplen = snaplen
+        self.timescale = timescale
+        self.tsoffset = tsoffset
+
+
+class PcapngReader(PacketReader):
+    """
+    PcapngReader: reader for pcapng files.
+    The stream is read one block at a time, so sections of any size can be read.
+    Section Header, Interface Description, Enhanced Packet and Simple Packet
+    blocks are understood, all other blocks are skipped.
+    """
+
+    def __init__(self, fstream, magic=None):
+        """
+        Creates a PcapngReader from an open stream.
+        Takes one mandatory and one optional argument,
+         - fstream: The readable stream to use.
+         - magic: The first four bytes of the file.
+        If this is None, four bytes are read from the stream first.
+        """
+        self.stream = fstream
+
+        # Read magic number if not done so already.
+        if magic is None:
+            magic = self.stream.read(4)
+
+        if magic != PCAPNG_MAGIC:
+            raise PcapngFormatError("Invalid magic {0}".format(magic))
+
+        self.read_section_header()
+
+    def read_section_header(self, length_data=None):
+        """
+        Reads the rest of a Section Header Block, after the block type.
+        length_data is the block length field, if it has already been read.
+        This starts a new section, forgetting all interfaces.
+        """
+        if length_data is None:
+            length_data = self.stream.read(4)
+        byte_order = self.stream.read(4)
+        if len(length_data) < 4 or len(byte_order) < 4:
+            raise PcapngFormatError("Stream truncated.")
+
+        # The byte order magic follows the block length.
+        self.endian = pcapng_byte_order_resolve(bytes(byte_order))
+        self.block_header_struct = struct.Struct(self.endian + "II")
+        self.uint32_struct = struct.Struct(self.endian + "I")
+        self.option_struct = struct.Struct(self.endian + "HH")
+        self.idb_struct = struct.Struct(self.endian + "HHI")
+        self.epb_struct = struct.Struct(self.endian + "IIIII")
+
+        block_length = self.uint32_struct.unpack(length_data)[0]
+        body = self.read_block_body(block_length, 12)
+
+        self.version_major, self.version_minor = \
+            struct.unpack_from(self.endian + "HH", body)
+        self.interfaces = []
+
+    def read_block_body(self, block_length, already_read):
+        """
+        Reads the rest of a block, given its total length and how much of it
+        (including the block header) has been read. The trailer is discarded.
+        Returns a bytearray, so packet data taken from it is writable.
+        """
+        remaining = block_length - already_read
+        if block_length % 4 != 0 or remaining < PCAPNG_BLOCK_TRAILER_SIZE:
+            raise PcapngFormatError("Invalid block length {0}".format(block_length))
+
+        body = bytearray(remaining)
+        if self.stream.readinto(body) != remaining:
+            raise PcapngFormatError("Stream truncated.")
+
+        del body[-PCAPNG_BLOCK_TRAILER_SIZE:]
+        return body
+
+    def read_options(self, body, offset):
+        """Generator yielding (code, value) pairs from the options at offset in body."""
+        while offset + 4 <= len(body):
+            code, length = self.option_struct.unpack_from(body, offset)
+            if code == PCAPNG_OPT_ENDOFOPT:
+                return
+            offset += 4
+            yield code, body[offset:offset + length]
+            offset += pcapng_pad(length)
+
+    def read_interface(self, body):
+        """Creates a PcapngInterface from the body of an Interface Description Block."""
+        linktype, _, snaplen = self.idb_struct.unpack_from(body)
+        interface = PcapngInterface(linktype, snaplen)
+
+        for code, value in self.read_options(body, self.idb_struct.size):
+            if code == PCAPNG_OPT_IF_TSRESOL and len(value) >= 1:
+                interface.timescale = pcapng_tsresol_resolve(value[0])
+            elif code == PCAPNG_OPT_IF_TSOFFSET and len(value) >= 8:
+                interface.tsoffset = struct.unpack_from(self.endian + "q", value)[0]
+
+        return interface
+
+    def get_interface(self, interface_id):
+        """Returns the interface with the given index, raising on unknown interfaces."""
+        try:
+            return self.interfaces[interface_id]
+        except IndexError:
+            raise PcapngFormatError("Packet for undefined interface {0}".format(interface_id))
+
+    def read_packet(self):
+        """
+        Reads blocks from the stream until a packet block is found.
+        Returns a Packet object, or None on EOF.
+        """
+        while True:
+            header = self.stream.read(PCAPNG_BLOCK_HEADER_SIZE)
+            # Test for EOF or truncation
+            if len(header) == 0:
+                # EOF
+                return None
+            elif len(header) < PCAPNG_BLOCK_HEADER_SIZE:
+                # Truncation
+                raise PcapngFormatError("Stream truncated.")
+
+            # The SHB block type reads the same in either byte order.
+            if header[0:4] == PCAPNG_MAGIC:
+                # New section, the length is read after the byte order magic.
+                self.read_section_header(header[4:8])
+                continue
+
+            block_type, block_length = self.block_header_struct.unpack(header)
+            body = self.read_block_body(block_length, PCAPNG_BLOCK_HEADER_SIZE)
+
+            if block_type == PCAPNG_BLOCK_EPB:
+                interface_id, ts_high, ts_low, caplen, origlen = \
+                    self.epb_struct.unpack_from(body)
+                interface = self.get_interface(interface_id)
+
+                data_start = self.epb_struct.size
+                data_end = data_start + caplen
+                if data_end > len(body):
+                    raise PcapngFormatError("Packet data exceeds block.")
+
+                # (timestamp, linktype, origlen, data)
+                return Packet(
+                    ((ts_high << 32) | ts_low) * 10**9 // interface.timescale +
+                    interface.tsoffset * 10**9,
+                    interface.linktype,
+                    origlen,
+                    memoryview(body)[data_start:data_end])
+
+            elif block_type == PCAPNG_BLOCK_SPB:
+                # Simple packets belong to the first interface and have no timestamp.
+                interface = self.get_interface(0)
+                origlen = self.uint32_struct.unpack_from(body)[0]
+                caplen = min(origlen, len(body) - 4)
+                if interface.snaplen > 0:
+                    caplen = min(caplen, interface.snaplen)
+
+                return Packet(
+                    interface.tsoffset * 10**9,
+                    interface.linktype,
+                    origlen,
+                    memoryview(body)[4:4 + caplen])
+
+            elif block_type == PCAPNG_BLOCK_IDB:
+                self.interfaces.append(self.read_interface(body))
+
+            # Any other block is skipped.
+
+    def close(self):
+        """Closes the stream."""
+        self.stream.close()
+
+
+class PcapngWriter(BufferedPacketWriter):
+    """
+    PcapngWriter: writer for pcapng files.
+    A single little-endian section is written. An Interface Description Block
+    is written the first time a linktype is seen, so packets of different
+    linktypes can be written to one file.
+    Records are buffered, see BufferedPacketWriter for the flush policy.
+    """
+
+    def __init__(self, stream, tsresol=PCAPNG_DEFAULT_TSRESOL, snaplen=65535,
+                 buffer_size=PACKET_WRITE_BUFFER_SIZE, flush_interval=None):
+        """
+        Setup a new PcapngWriter object, and write a section header to the stream.
+        tsresol is the decimal timestamp resolution, as in the if_tsresol option,
+        e.g. 6 for microseconds or 9 for nanoseconds.
+        """
+        super().__init__(stream, buffer_size, flush_interval)
+        self.tsresol = tsresol
+        self.timescale = 10**tsresol
+        self.snaplen = snaplen
+
+        # Maps a linktype to the index of the interface describing it.
+        self.interfaces = {}
+
+        # Section Header Block, with an unspecified (-1) section length.
+        self.write_block(PCAPNG_BLOCK_SHB, PCAPNG_LE_BYTE_ORDER + struct.pack(
+            "<HHq", PCAPNG_MAJOR_VER, PCAPNG_MINOR_VER, -1))
+        self.flush_if_due()
+
+    def write_block(self, block_type, body):
+        """Appends a block with the given type and (padded) body to the buffer."""
+        block_length = PCAPNG_BLOCK_HEADER_SIZE + len(body) + PCAPNG_BLOCK_TRAILER_SIZE
+        self.buffer += struct.pack("<II", block_type, block_length)
+        self.buffer += body
+        self.buffer += struct.pack("<I", block_length)
+
+    def add_interface(self, linktype):
+        """Writes an Interface Description Block for a linktype, returning its index."""
+        body = struct.pack("<HHI", linktype, 0, self.snaplen)
+        if self.tsresol != PCAPNG_DEFAULT_TSRESOL:
+            body += struct.pack("<HHB3x", PCAPNG_OPT_IF_TSRESOL, 1, self.tsresol)
+            body += struct.pack("<HH", PCAPNG_OPT_ENDOFOPT, 0)
+        self.write_block(PCAPNG_BLOCK_IDB, body)
+
+        interface_id = len(self.interfaces)
+        self.interfaces[linktype] = interface_id
+        return interface_id
+
+    def pack_packet(self, packet, buf):
+        """Appends an Enhanced Packet Block for the packet to buf."""
+        interface_id = self.interfaces.get(packet.linktype)
+        if interface_id is None:
+            interface_id = self.add_interface(packet.linktype)
+
+        # Truncate packet.data to the snaplen limit, if needed.
+        maxlen = min(self.snaplen, len(packet.data))
+        padding = pcapng_pad(maxlen) - maxlen
+        block_length = 32 + maxlen + padding
+
+        timestamp = packet.timestamp * self.timescale // 10**9
+        if timestamp < 0:
+            raise PcapngFormatError("Packet cannot be represented (negative time)")
+
+        buf += struct.pack("<IIIIIII", PCAPNG_BLOCK_EPB, block_length,
+                           interface_id, timestamp >> 32, timestamp & 0xFFFFFFFF,
+                           maxlen, packet.origlen)
+        # Slice a memoryview, so the data is only copied into the buffer.
+        buf += memoryview(packet.data)[:maxlen]
+        buf += bytes(padding)
+        buf += struct.pack("<I", block_length)
@@ -1,6 +1,7 @@
 """
 common:
  - Definition for the 'Packet' class
+ - Definition for the 'PacketBatch' class, a columnar collection of packets.
  - Functions for operating on the 'Packet' class.
  - Functions for handling generic user input, i.e. parse_int.
  - Functions for converting a ip4/ip6/mac address to string form and back.
@@ -9,52 +10,111 @@ psuedopackets being older then or newer then all other packets, respectively.
 """
 
 import enum
+import array
 
 import time
 import binascii
 
 
 class Packet:
-    """Class consisting of five fields,
-     - unixtime: Floating point number, time in seconds since 1st Jan, 1970.
+    """Class consisting of six fields,
+     - timestamp: Integer, time in nanoseconds since 1st Jan, 1970.
      - linktype: Integer constant representing the root format of the
                  packet as specified by the source.
      - origlen: Original length of the 'data' field.
-     - data: Packet data as a bytearray.
-     - identity: The root protocol instance.
+     - data: Packet data as a bytearray, or a writable memoryview.
+     - identity: The root protocol instance. It may be held in a compact
+                 form (see identity.compact), which is expanded when next read.
+     - sequence: Position of the packet in its source, if set by a stage
+                 that reorders packets (such as unordered identify) or
+                 by parallel.scan_chunk (the record's file offset), or None.
 
     Comparison operator methods and the length method are implemented.
-    Comparisons work on the value of unixtime, so a < b means a is older then b.
-    The length is 'origlen', so len(a) < len(b) means a was shorter then b."""
+    The 'unixtime' property gives the time in (floating point) seconds.
 
-    __slots__ = ["unixtime", "linktype", "origlen", "data", "identity"]
+    Comparisons work on the value of timestamp, so a < b means a is older then b.
+    The length is 'origlen', so len(a) < len(b) means a was shorter then b.
+    Memoryviews (such as those handed out by a memory mapped reader) are used
+    as is, anything else is copied into a new bytearray."""
 
-    def __init__(self, ut, lt, ol, dat):
-        self.unixtime = ut
+    __slots__ = ["timestamp", "linktype", "origlen", "data", "_identity", "sequence"]
+
+    def __init__(self, ts, lt, ol, dat):
+        self.timestamp = ts
         self.linktype = lt
         self.origlen = ol
-        self.data = bytearray(dat)
-        self.identity = None
-
-    # Implement comprison operations based on 'unixtime', such that:
+        if isinstance(dat, memoryview):
+            self.data = dat
+        else:
+            self.data = bytearray(dat)
+        self._identity = None
+        self.sequence = None
+
+    @property
+    def identity(self):
+        """The root protocol instance, expanded if it was compacted."""
+        identity = self._identity
+        if type(identity) is array.array:
+            from .identity.compact import expand_identity
+            identity = self._identity = expand_identity(identity, self.data, self.timestamp)
+        return identity
+
+    @identity.setter
+    def identity(self, identity):
+        self._identity = identity
+
+    @property
+    def compacted(self):
+        """True if the identity is held in compact form."""
+        return type(self._identity) is array.array
+
+    def compact(self):
+        """
+        Holds the identity in compact form, as a table of protocols and their
+        offsets rather than protocol instances, to save memory while the
+        packet waits in a buffer. Protocol instances are rebuilt when the
+        identity is next read. Only complete identities are compacted.
+        Returns True if the identity is (now) held in compact form.
+        """
+        identity = self._identity
+        if identity is None or type(identity) is array.array:
+            return identity is not None
+
+        from .identity.compact import compact_identity
+        table = compact_identity(identity)
+        if table is None:
+            return False
+        self._identity = table
+        return True
+
+    @property
+    def unixtime(self):
+        """Time in seconds since 1st Jan, 1970, derived from timestamp."""
+        return self.timestamp / 10**9
+
+    @unixtime.setter
+    def unixtime(self, ut):
+        self.timestamp = round(ut * 10**9)
+
+    # Implement comprison operations based on 'timestamp', such that:
     # a < b means a is older then b.
     def __lt__(self, other):
-        return self.unixtime < other.unixtime
+        return self.timestamp < other.timestamp
 
     def __le__(self, other):
-        return self.unixtime <= other.unixtime
+        return self.timestamp <= other.timestamp
 
     def __eq__(self, other):
-        return self.unixtime == other.unixtime
+        return self.timestamp == other.timestamp
 
     def __ne__(self, other):
-        return self.unixtime != other.unixtime
+        return self.timestamp != other.timestamp
 
     def __gt__(self, other):
-        return self.unixtime > other.unixtime
+        return self.timestamp > other.timestamp
 
     def __ge__(self, other):
-        return self.unixtime >= other.unixtime
+        return self.timestamp >= other.timestamp
 
     # Implement length func based on 'origlen', such that:
     # len(a) < len(b) means a has an original length shorter then b.
@@ -84,6 +144,61 @@ class Packet:
  Original length: {3}, Captured length: {4}".format(*fmtargs)
 
 
+class PacketBatch:
+    """Columnar collection of packets. Instead of one Packet object per packet,
+a batch holds one array per field,
+     - timestamps: Times in nanoseconds since 1st Jan, 1970.
+     - linktypes: Linktypes.
+     - origlens: Original lengths.
+     - caplens: Captured lengths, the length of each packet's data.
+     - offsets: Offset of each packet's data in the payload buffer.
+     - payload: A bytearray containing the data of every packet, back to back.
+
+    Indexing or iterating over a batch produces Packet objects whose data is a
+    memoryview of the payload buffer, for use with existing pipeline stages.
+    Changes to these packets' data are seen by the batch, other fields are copies.
+    Packets cannot be appended while any such packets are still referenced."""
+
+    __slots__ = ["timestamps", "linktypes", "origlens", "caplens", "offsets", "payload"]
+
+    def __init__(self):
+        self.timestamps = array.array("q")
+        self.linktypes = array.array("I")
+        self.origlens = array.array("I")
+        self.caplens = array.array("I")
+        self.offsets = array.array("Q")
+        self.payload = bytearray()
+
+    def append(self, ts, lt, ol, dat):
+        """Adds a packet to the batch, copying its data into the payload buffer."""
+        self.timestamps.append(ts)
+        self.linktypes.append(lt)
+        self.origlens.append(ol)
+        self.caplens.append(len(dat))
+        self.offsets.append(len(self.payload))
+        self.payload += dat
+
+    def append_packet(self, packet):
+        """Adds a Packet object to the batch."""
+        self.append(packet.timestamp, packet.linktype, packet.origlen, packet.data)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __getitem__(self, idx):
+        """Returns a Packet for the packet at index idx."""
+        offset = self.offsets[idx]
+        return Packet(
+            self.timestamps[idx], self.linktypes[idx], self.origlens[idx],
+            memoryview(self.payload)[offset:offset + self.caplens[idx]])
+
+    def __iter__(self):
+        """Generator method producing a Packet for every packet in the batch."""
+        payload = memoryview(self.payload)
+        for ts, lt, ol, offset, caplen in zip(self.timestamps, self.linktypes,
+                                              self.origlens, self.offsets, self.caplens):
+            yield Packet(ts, lt, ol, payload[offset:offset + caplen])
+
 
 def parse_int(intstr):
     """Simple string -> integer parsing/guessing function.
@@ -178,8 +293,9 @@ Returns None on a format error."""
         if "::" in ip6s:
             ip6i_start, ip6i_end = ip6s.split("::")
 
-            ip6i_start = [f(pair) for pair in ip6i_start.split(":") for f in expand]
-            ip6i_end = [f(pair) for pair in ip6i_end.split(":") for f in expand]
+            # Either side may be empty, as in "::1" or "2001:db8::".
+            ip6i_start = [f(pair) for pair in ip6i_start.split(":") if ip6i_start for f in expand]
+            ip6i_end = [f(pair) for pair in ip6i_end.split(":") if ip6i_end for f in expand]
             ip6i = ip6i_start + [0]*(16 - (len(ip6i_start) + len(ip6i_end))) + ip6i_end
         else:
             #ip6i = [expand(pair) for pair in ip6s.split(":")]
@@ -1,9 +1,11 @@
+import struct
+
 from .. import common
 
 from . import core
 from . import eth
 
-from .core import uint16pack, uint16unpack
+from .core import uint16pack
 
 # RFC 826: An Ethernet Address Resolution Protocol
 #
@@ -38,14 +40,27 @@ ARP_OPCODE_REPLY = 2
 # Minimum size for a valid ARP packet.
 ARP_MIN_SIZE = 8
 
+# Layout of the fixed (8 byte) part of the packet.
+ARP_HEADER = struct.Struct("!HHBBH")
+
 
 class ARP(core.Protocol):
     name = "arp"
 
-    __slots__ = {"_htype", "_ptype", "_hlen", "_plen", "_opcode",
-        "_sha", "_spa", "_tha", "_tpa",
+    __slots__ = {"_sha", "_spa", "_tha", "_tpa",
         "hardware_is_ethernet", "protocol_is_ipv4"}
 
+    header_fields = ("htype", "ptype", "hlen", "plen", "opcode")
+    attribute_fields = ("htype", "ptype", "opcode", "sha", "spa", "tha", "tpa")
+    unordered_fields = ("sha", "spa", "tha", "tpa")
+
+    # Fixed fields, for writing. Fields are read with get_header.
+    _htype = slice(0, 2)
+    _ptype = slice(2, 4)
+    _hlen = 4
+    _plen = 5
+    _opcode = slice(6, 8)
+
     def __init__(self, data, prev):
         super().__init__(data, prev)
         if len(data) < ARP_MIN_SIZE:
@@ -54,16 +69,9 @@ class ARP(core.Protocol):
         self._calculate_offsets()
 
     def _calculate_offsets(self):
-        # Fixed offsets.
-        self._htype = slice(0, 2)
-        self._ptype = slice(2, 4)
-        self._hlen = 4
-        self._plen = 5
-        self._opcode = slice(6, 8)
+        htype, ptype, hlen, plen, _ = self.get_header()
 
         # Variable offsets.
-        hlen = self.data[self._hlen]
-        plen = self.data[self._plen]
 
         addrbase = 8
 
@@ -72,9 +80,6 @@ class ARP(core.Protocol):
         self._tha = slice(addrbase+hlen+plen, addrbase+2*hlen+plen)
         self._tpa = slice(addrbase+2*hlen+plen, addrbase+2*hlen+2*plen)
 
-        htype = uint16unpack(self.data[self._htype])
-        ptype = uint16unpack(self.data[self._ptype])
-
         # These values are used by replace_hosts.
         self.hardware_is_ethernet = (htype == ARP_HARDWARE_ETHERNET) and\
             (hlen == 6) and (len(self.data) >= ARP_MIN_SIZE + 20)
@@ -85,6 +90,8 @@ class ARP(core.Protocol):
     def replace_hosts(self, hostmap):
         """This method replaces MAC and IP addresses of both the sender and
 target based on the given mapping."""
+        self.invalidate_attributes()
+
         if self.hardware_is_ethernet:
             macmap = hostmap[core.AddrType.MAC.value]
 
@@ -107,12 +114,17 @@ target based on the given mapping."""
             if tip in ipmap:
                 self.data[self._tpa] = ipmap[tip]
 
+    def get_header(self):
+        """Decodes the fixed fields, returning a (htype, ptype, hlen, plen, opcode) tuple."""
+        return core.unpack_from(ARP_HEADER, self.data)
+
     def get_attributes(self):
         """Retrieve a set of attributes describing fields in this protocol."""
+        htype, ptype, _, _, opcode = self.get_header()
         return {
-            "htype": uint16unpack(self.data[self._htype]),
-            "ptype": uint16unpack(self.data[self._ptype]),
-            "opcode": uint16unpack(self.data[self._opcode]),
+            "htype": htype,
+            "ptype": ptype,
+            "opcode": opcode,
             "sha": bytes(self.data[self._sha]),
             "spa": bytes(self.data[self._spa]),
             "tha": bytes(self.data[self._tha]),
@@ -121,12 +133,14 @@ target based on the given mapping."""
 
     def set_attributes(self, attrs):
         """Alter packet data to match a set of protocol attributes."""
+        self.invalidate_attributes()
+
         hlen = self.data[self._hlen]
         plen = self.data[self._plen]
         if "htype" in attrs:
             self.data[self._htype] = uint16pack(attrs["htype"] & 0xFFFF)
         if "ptype" in attrs:
-            self.data[self._htype] = uint16pack(attrs["ptype"] & 0xFFFF)
+            self.data[self._ptype] = uint16pack(attrs["ptype"] & 0xFFFF)
         if "opcode" in attrs:
             self.data[self._opcode] = uint16pack(attrs["opcode"] &  0xFFFF)
 
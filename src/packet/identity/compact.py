@@ -0,0 +1,108 @@
+"""
+compact: flat, array backed packet identities.
+An identity is normally a linked list of protocol instances, each with its
+own memoryview of the packet data. A compact identity holds the same thing as
+a table in a single array of integers, with one row per protocol:
+
+    (protocol id, header offset, header length, payload length)
+
+Offsets are from the start of the packet data. Protocol ids index
+compact_protocols, and are handed out as protocols are first compacted.
+A row with a header length of COMPACT_PENDING stands for a child protocol
+that was not yet interpreted (see Protocol.interpret_next); its payload
+length is the length of the data it is to interpret. It is interpreted at
+the packet's timestamp when read.
+
+Protocol instances are rebuilt from the table, by their constructors, when
+the identity is next used. Only complete identities whose protocols derive
+everything from their own data (see Protocol.compactable) are compacted.
+"""
+
+import array
+
+# Number of integers in a row of the table.
+COMPACT_ROW_SIZE = 4
+
+# Header length of a row standing for a deferred protocol.
+COMPACT_PENDING = -1
+
+# Protocol classes, by id, and ids, by protocol class.
+compact_protocols = []
+compact_ids = {}
+
+
+def protocol_id(protocol):
+    """Returns the id of a protocol class, assigning one if it has none."""
+    pid = compact_ids.get(protocol)
+    if pid is None:
+        pid = compact_ids[protocol] = len(compact_protocols)
+        compact_protocols.append(protocol)
+    return pid
+
+
+def compact_identity(identity):
+    """
+    Returns the table for a root protocol instance (as set by
+    core.root_identify), or None if the identity cannot be compacted.
+    """
+    table = array.array("i")
+    offset = 0
+    layer = identity
+
+    while True:
+        if not layer.completed or not isinstance(layer.data, memoryview) or \
+                not layer.compactable():
+            return None
+
+        size = len(layer.data)
+        # Children are interpreted from the payload offset of carriers,
+        # other protocols are all header.
+        payload_offset = getattr(layer, "payload_offset", None)
+        header = size if payload_offset is None else payload_offset
+        table.extend((protocol_id(type(layer)), offset, header, size - header))
+
+        if layer._pending is not None:
+            protocol, start, end, _ = layer._pending
+            start, end, _ = slice(start, end).indices(size)
+            table.extend((protocol_id(protocol), offset + start, COMPACT_PENDING, max(0, end - start)))
+            return table
+
+        child = layer._child
+        if child is None:
+            return table
+        if payload_offset is None:
+            # A child of a protocol without a payload offset can't be placed.
+            return None
+
+        offset += header
+        layer = child
+
+
+def expand_identity(table, data, timestamp):
+    """
+    Rebuilds the protocol instances described by a table, over the data
+    of a packet with the given timestamp (for a deferred protocol).
+    """
+    view = memoryview(data)
+    root = None
+    prev = None
+    prev_offset = 0
+
+    for row in range(0, len(table), COMPACT_ROW_SIZE):
+        pid, offset, header, payload = table[row:row + COMPACT_ROW_SIZE]
+        protocol = compact_protocols[pid]
+
+        if header == COMPACT_PENDING:
+            start = offset - prev_offset
+            prev._pending = (protocol, start, start + payload, timestamp)
+            break
+
+        layer = protocol(view[offset:offset + header + payload], prev)
+        if prev is None:
+            root = layer
+        else:
+            prev._child = layer
+        prev = layer
+        prev_offset = offset
+
+    return root
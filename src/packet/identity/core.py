@@ -21,6 +21,19 @@ class Stream:
 ATTRIBUTE_WILDCARD = None
 
 
+class AttributeMatcher:
+    """
+    Base class for prototype attribute values matching a set of values,
+    rather than a single one (such as an address prefix).
+    match_attributes calls the matches method with the instance's value.
+    """
+    __slots__ = ()
+
+    def matches(self, value):
+        """Abstract method. Should return True if value is in the set."""
+        raise NotImplementedError("matches not implemented.")
+
+
 class ProtocolFormatError(Exception):
     """Exception raised when a protocol class encounters an error dissecting a packet."""
     pass
@@ -34,19 +47,63 @@ class Protocol:
     of variable data in a protocol, for instance, a sender's IP address
     is an attribute of an IP header. A protocol also has a 'next' and 'prev' - 
     child and parent protocols, respectively.
-    All protocol instances have a 'completed' flag.
+    All protocol instances have a 'completed' flag, and a 'depth', the number
+    of protocols before it (0 for the root protocol).
+    The child protocol may be interpreted lazily, see interpret_next.
+    Attributes are cached by get_cached_attributes; methods changing the
+    data must call invalidate_attributes.
     """
 
     name = None
-    __slots__ = {"data", "next", "prev", "completed"}
+    __slots__ = {"data", "_child", "_pending", "prev", "completed", "depth", "_attributes"}
+
+    # Names of the fields returned by get_header, for protocols with one.
+    header_fields = ()
+
+    # Keys of the dict returned by get_attributes.
+    attribute_fields = ()
+
+    # Header fields and attributes that are not integers (such as addresses),
+    # so can only be compared for equality.
+    unordered_fields = ()
 
 
     def __init__(self, data, prev):
         """Constructor for protocol instances. """
         self.data = data
-        self.next = None
+        self._child = None
+        self._pending = None
         self.prev = prev
         self.completed = True
+        self.depth = 0 if prev is None else prev.depth + 1
+        self._attributes = None
+
+    @property
+    def next(self):
+        """The child protocol instance, interpreted now if it was deferred."""
+        if self._pending is not None:
+            protocol, start, end, time = self._pending
+            self._pending = None
+            self._child = interpret_deferred(protocol, self.data[start:end], self, time)
+        return self._child
+
+    @next.setter
+    def next(self, child):
+        self._pending = None
+        self._child = child
+
+    def interpret_next(self, protocol, start, end=None):
+        """
+        Sets the child protocol to 'protocol' interpreting data[start:end].
+        If the child would be deeper than the depth limit given to
+        root_identify, it is only interpreted when 'next' is first read,
+        at the time of its own packet (see interpret_deferred).
+        """
+        if dissect_depth is not None and self.depth + 1 >= dissect_depth:
+            self._child = None
+            self._pending = (protocol, start, end, packet_time)
+        else:
+            self.next = protocol.interpret_packet(self.data[start:end], self)
 
     def __iter__(self):
         """Generator method for accessing this/child protocol instances."""
@@ -56,13 +113,25 @@ class Protocol:
             current = current.next
 
     def is_complete(self):
-        """Returns True if this and all child protocols are complete."""
-        if not self.completed:
-            return False
+        """
+        Returns True if this and all child protocols are complete.
+        Deferred child protocols are not interpreted, and count as complete.
+        """
+        current = self
+        while current is not None:
+            if not current.completed:
+                return False
+            current = current._child
 
-        if self.next is not None:
-            return self.next.is_complete()
+        return True
 
+    def compactable(self):
+        """
+        Returns True if this instance can be rebuilt by the constructor from
+        its data and parent alone, so it may be held as a compact identity
+        (see the compact module). Protocols that keep other state in
+        their instances should return False when they do.
+        """
         return True
 
     def get_attributes(self):
@@ -72,10 +141,24 @@ class Protocol:
         """
         raise NotImplementedError("get_attributes not implemented.")
 
+    def get_cached_attributes(self):
+        """
+        Returns the dict from get_attributes, computed once per instance.
+        The dict is shared, and must not be changed by the caller.
+        """
+        if self._attributes is None:
+            self._attributes = self.get_attributes()
+        return self._attributes
+
+    def invalidate_attributes(self):
+        """Forgets cached attributes, after the data has been changed."""
+        self._attributes = None
+
     def set_attributes(self, attrs):
         """
         Abstract method set_attributes.
-        Should accept a dict of attributes and update data accordingly.
+        Should accept a dict of attributes and update data accordingly,
+        calling invalidate_attributes if anything was changed.
         """
         raise NotImplementedError("set_attributes not implemented.")
 
@@ -86,31 +169,31 @@ class Protocol:
         instance (from get_attributes) to the provided attributes (tattrs).
         This is not commutative - all of the target keys MUST be in
         this ProtocolIdentity's keys. Additionally, if the target's key is
-        equal to None, it is treated as a wildcard and matches.
+        equal to None, it is treated as a wildcard and matches, and if it is
+        an AttributeMatcher, its matches method decides.
         """
         # Retrieve attributes.
-        sattrs = self.get_attributes()
-
-        tkeys = set(tattrs.keys())
-        skeys = set(sattrs.keys())
-
-        # Check if tkeys is a weak subset of skeys.
-        if tkeys <= skeys:
-            for key in tkeys & skeys:
-                # Check for mismatch.
-                if sattrs[key] != tattrs[key] and \
-                    tattrs[key] is not ATTRIBUTE_WILDCARD:
-                    break
-            else:
-                # If loop did not find mismatches...
-                return True
-        # In all other cases...
-        return False
+        sattrs = self.get_cached_attributes()
+
+        for key, value in tattrs.items():
+            # Every target key must be present, wildcard or not.
+            if key not in sattrs:
+                return False
+            # Check for mismatch.
+            if value is ATTRIBUTE_WILDCARD:
+                continue
+            if isinstance(value, AttributeMatcher):
+                if not value.matches(sattrs[key]):
+                    return False
+            elif sattrs[key] != value:
+                return False
+        return True
 
     def replace_hosts(self, hostmap):
         """
         This method should replace instances of host identification,
-        namely IP addresses and MAC addresses.
+        namely IP addresses and MAC addresses, calling invalidate_attributes
+        if anything was replaced.
         This operation should propagate to child protocols.
         The default implementation does nothing other then this propogation
         and should suffice for protocols without any kind of host identification.
@@ -186,6 +269,7 @@ class CarrierProtocol(Protocol):
     In addition to the Protocol methods, a CarrierProtocol needs to implement
     the get_route and get_route_reciprocal methods.
     """
+    __slots__ = ()
 
     def get_route(self):
         """
@@ -261,7 +345,11 @@ def uint16pack(i):
 
 def uint16unpack(b):
     """Converts bytes into a 16-bit int (big endian)"""
-    return uint16.unpack(b)[0]
+    try:
+        return uint16.unpack(b)[0]
+    except TypeError:
+        # Not a buffer, such as a memorymap spanning several fragments.
+        return uint16.unpack(bytes(b))[0]
 
 
 def uint32pack(i):
@@ -271,12 +359,29 @@ def uint32pack(i):
 
 def uint32unpack(b):
     """Converts bytes into a 32-bit int (big endian)"""
-    return uint32.unpack(b)[0]
+    try:
+        return uint32.unpack(b)[0]
+    except TypeError:
+        # Not a buffer, such as a memorymap spanning several fragments.
+        return uint32.unpack(bytes(b))[0]
+
+
+def unpack_from(layout, data, offset=0):
+    """
+    Unpacks a struct.Struct layout from data at offset, as layout.unpack_from,
+    but also accepts data not supporting the buffer interface (a memorymap).
+    Protocol classes declare their fixed header layouts once, at class level,
+    and decode them with this.
+    """
+    try:
+        return layout.unpack_from(data, offset)
+    except TypeError:
+        return layout.unpack(bytes(data[offset:offset + layout.size]))
 
 # Functions dealing with identification,
 # protocol registration and linktype registration.
 
-def root_identify(packet):
+def root_identify(packet, depth=None):
     """
     Identify a packet.
     This function may have side effects.
@@ -284,18 +389,55 @@ def root_identify(packet):
     This function may return packets with an incomplete identity (is_complete() == False).
     Packets with an incomplete identity can and will have their identities
     updated whenever a protocol class deems suitable.
+    The packet's time is made available to protocol classes as packet_time,
+    for expiring state.
+    If depth is not None, only the first 'depth' protocols are interpreted,
+    deeper ones are interpreted when first accessed. Stateful protocols
+    (such as IP fragment tracking) only see packets interpreted that deep.
+    Instances of earlier packets this packet completes are listed in
+    completed_instances (see mark_completed) until the next call.
     """
-    if packet.linktype in linktype_registry:
-        protocol = lookup_protocol(linktype_registry[packet.linktype])
-    else:
-        protocol = ProtocolStub
+    global packet_time, dissect_depth
+    packet_time = packet.timestamp
+    dissect_depth = depth
+    completed_instances.clear()
+
+    protocol = linktype_dispatch.get(packet.linktype, ProtocolStub)
 
-    
     packet.identity = protocol.interpret_packet(memoryview(packet.data), None)
     if packet.identity == None:
         packet.identity = ProtocolStub(memoryview(packet.data), None)
 
 
+def interpret_deferred(protocol, data, parent, time):
+    """
+    Interprets a child protocol deferred by interpret_next, as root_identify
+    would have for its packet: with packet_time set to the packet's time
+    (so stateful protocols expire state as they would have), and with the
+    protocols below it deferred in turn. Deferred children should be read
+    in packet order, as stateful protocols see them when they are read.
+    """
+    global packet_time, dissect_depth
+    saved = packet_time, dissect_depth
+    # Any limit no deeper than the child defers its own children.
+    packet_time, dissect_depth = time, parent.depth + 1
+    try:
+        return protocol.interpret_packet(data, parent)
+    finally:
+        packet_time, dissect_depth = saved
+
+
+def mark_completed(instance):
+    """
+    Marks an incomplete protocol instance complete. Stateful protocols call
+    this when a later packet completes an instance, which is then listed in
+    completed_instances, so that identify only checks the packets that may
+    have become complete.
+    """
+    instance.completed = True
+    completed_instances.append(instance)
+
+
 def register_linktype(protoname, linktype):
     """
     This function adds a protocol to the linktype registry.
@@ -304,6 +446,7 @@ def register_linktype(protoname, linktype):
     defined in packet.common.LinkType
     """
     linktype_registry[linktype] = protoname
+    rebuild_dispatch()
 
 
 def register_protocol(protocol):
@@ -312,6 +455,33 @@ def register_protocol(protocol):
     The protocol registry maps a protocol's name to it's class.
     """
     protocol_registry[protocol.name] = protocol
+    rebuild_dispatch()
+
+
+def register_dispatch(builder):
+    """
+    Adds a dispatch table builder, and calls it.
+    Registries map numbers (linktypes, ethertypes, ...) to protocol names,
+    so that protocols can be overridden by name. Rather than resolving both
+    for every packet, a builder fills a table mapping the numbers directly
+    to protocol classes. Builders are called again whenever any registry
+    changes, through rebuild_dispatch.
+    """
+    dispatch_builders.append(builder)
+    builder()
+
+
+def rebuild_dispatch():
+    """Rebuilds all dispatch tables. Registration functions call this."""
+    for builder in dispatch_builders:
+        builder()
+
+
+def build_linktype_dispatch():
+    """Builds linktype_dispatch, mapping linktypes to protocol classes."""
+    linktype_dispatch.clear()
+    for linktype, protoname in linktype_registry.items():
+        linktype_dispatch[linktype] = lookup_protocol(protoname)
 
 
 def lookup_protocol(protoname):
@@ -327,5 +497,21 @@ def lookup_protocol(protoname):
     return protocol
 
 
+# Time of the packet being identified, in nanoseconds, set by root_identify.
+# State trackers should use this rather than wall time, so that captures are
+# identified the same way however fast they are read.
+packet_time = 0
+
+# Number of protocols root_identify interprets, or None for all of them.
+dissect_depth = None
+
+# Protocol instances completed while identifying the current packet.
+completed_instances = []
+
 linktype_registry = {}
 protocol_registry = {}
+
+dispatch_builders = []
+linktype_dispatch = {}
+
+register_dispatch(build_linktype_dispatch)
@@ -3,10 +3,12 @@ Ethernet dissection module.
 Contains the Ethernet (eth) Protocol class, and a handful of constants.
 """
 
+import struct
+
 from .. import common
 
 from . import core
-from .core import uint16pack, uint16unpack
+from .core import uint16pack
 
 # Ethernet frames have a fairly consistent format.
 # A packet capture will typically contain the
@@ -51,11 +53,14 @@ ETHERTYPE_IEEE802_1AD = 0x88A8
 # That occasionally crop up carrying protocols like ARP.
 ETHERNET_MIN_FRAME_SIZE = 16
 
+# Layout of an ethertype (or 1Q/1AD identifier) field.
+ETHERTYPE_FIELD = struct.Struct("!H")
+
 
 def find_ethertype_offset(data):
     """Finds the offset of the true ethertype of a frame."""
     # Tenative 'EtherType'
-    ethertype = uint16unpack(data[12:14])
+    ethertype, = core.unpack_from(ETHERTYPE_FIELD, data, 12)
     # Check for 1Q/1AD frames.
     if ethertype == ETHERTYPE_IEEE802_1Q:
         # skip 4 bytes to account for 1Q header.
@@ -72,7 +77,14 @@ def find_ethertype_offset(data):
 class Ethernet(core.CarrierProtocol):
     """Class representing the Ethernet II (IEEE 802.3/1Q/1AD) protocol."""
     name = "eth"
-    __slots__ = {"payload_offset", "_dmac", "_smac", "_ethertype"}
+    __slots__ = {"payload_offset"}
+
+    attribute_fields = ("dmac", "smac", "ethertype")
+    unordered_fields = ("dmac", "smac")
+
+    # Fixed fields.
+    _dmac = slice(0, 6)
+    _smac = slice(6, 12)
 
     def __init__(self, data, prev):
         """Constructor."""
@@ -83,20 +95,12 @@ class Ethernet(core.CarrierProtocol):
         self._calculate_offsets()
 
     def _calculate_offsets(self):
-        """Calculates offsets of all the fields and the payload."""
-        self._dmac = slice(0, 6)
-        self._smac = slice(6, 12)
-
-        etype_offset = find_ethertype_offset(
-            self.data[0:16]
-        )
-        self._ethertype = slice(etype_offset, etype_offset+2)
-
-        self.payload_offset = etype_offset + 2
+        """Calculates the offset of the payload. The ethertype precedes it."""
+        self.payload_offset = find_ethertype_offset(self.data) + 2
 
     def get_ethertype(self):
         """Returns the ethertype as a number."""
-        return uint16unpack(self.data[self._ethertype])
+        return core.unpack_from(ETHERTYPE_FIELD, self.data, self.payload_offset - 2)[0]
 
     def get_route(self):
         """Returns the route of this ethernet header, as a 12-byte string."""
@@ -122,6 +126,9 @@ class Ethernet(core.CarrierProtocol):
         if smac in macmap:
             self.data[self._smac] = macmap[smac]
 
+        if dmac in macmap or smac in macmap:
+            self.invalidate_attributes()
+
         if self.next is not None:
             self.next.replace_hosts(hostmap)
 
@@ -137,6 +144,8 @@ class Ethernet(core.CarrierProtocol):
 
     def set_attributes(self, attrs):
         """Updates the fields in this header to represent the contents of an attribute dict."""
+        self.invalidate_attributes()
+
         # Get updated values
         if "dmac" in attrs:
             self.data[self._dmac] = attrs["dmac"]
@@ -149,29 +158,25 @@ class Ethernet(core.CarrierProtocol):
             # We don't support adding 1Q/1AD headers at the moment.
             if new_ethertype != ETHERTYPE_IEEE802_1Q and \
                 new_ethertype != ETHERTYPE_IEEE802_1AD:
-                self.data[self._ethertype] = uint16pack(new_ethertype & 0xFFFF)
+                etype_offset = self.payload_offset - 2
+                self.data[etype_offset:etype_offset + 2] = uint16pack(new_ethertype & 0xFFFF)
 
     @staticmethod
     def interpret_packet(data, parent):
         """
         Creates a protocol instance and determines the next protocol to use.
         This makes use of a registry of ethertype -> protocol names, updated
-        with the 'register_ethertype' function in this module.
+        with the 'register_ethertype' function in this module, through
+        the ethertype_dispatch table.
         """
         try:
             instance = Ethernet(data, parent)
         except core.ProtocolFormatError:
             return None
 
-        ethertype = instance.get_ethertype()
-
-        if ethertype in ethertype_registry:
-            protoname = ethertype_registry[ethertype]
-            protocol = core.lookup_protocol(protoname)
-
-            instance.next = protocol.interpret_packet(
-                data[instance.payload_offset:], instance
-            )
+        protocol = ethertype_dispatch.get(instance.get_ethertype())
+        if protocol is not None:
+            instance.interpret_next(protocol, instance.payload_offset)
 
         return instance
 
@@ -213,9 +218,20 @@ class Ethernet(core.CarrierProtocol):
 def register_ethertype(protocol, ethertype):
     """Associates a protocol name with an ethertype."""
     ethertype_registry[ethertype] = protocol
+    core.rebuild_dispatch()
+
+
+def build_ethertype_dispatch():
+    """Builds ethertype_dispatch, mapping ethertypes to protocol classes."""
+    ethertype_dispatch.clear()
+    for ethertype, protoname in ethertype_registry.items():
+        ethertype_dispatch[ethertype] = core.lookup_protocol(protoname)
 
 
 ethertype_registry = {}
+ethertype_dispatch = {}
+
+core.register_dispatch(build_ethertype_dispatch)
 
 # Register the protocol, and as a linktype handler.
 core.register_protocol(Ethernet)
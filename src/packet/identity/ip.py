@@ -4,6 +4,8 @@ Internet Protocol Number registry and checksum algorithm.
 """
 import struct
 
+from .. import radix
+
 from . import core
 
 
@@ -37,17 +39,71 @@ def checksum(data):
 def register_ip_protocol(protoname, protonum):
     """Add a protocol number <-> name mapping."""
     ip_protocol_registry[protonum] = protoname
+    core.rebuild_dispatch()
 
 
 def lookup_ip_protocol(protonum):
-    """Looks up a protocol name from number."""
-    if protonum in ip_protocol_registry:
-        protoname = ip_protocol_registry[protonum]
-        return core.lookup_protocol(protoname)
-    return None
+    """Looks up a protocol class from number, or None if it is not registered."""
+    return ip_protocol_dispatch.get(protonum)
+
+
+def build_ip_protocol_dispatch():
+    """Builds ip_protocol_dispatch, mapping protocol numbers to protocol classes."""
+    ip_protocol_dispatch.clear()
+    for protonum, protoname in ip_protocol_registry.items():
+        ip_protocol_dispatch[protonum] = core.lookup_protocol(protoname)
+
+
+class PrefixMatcher(core.AttributeMatcher):
+    """Attribute value matching addresses covered by a radix.PrefixSet."""
+    __slots__ = {"prefixes"}
+
+    def __init__(self, prefixes):
+        self.prefixes = prefixes
+
+    def matches(self, value):
+        return value in self.prefixes
+
+
+def build_address_attribute(addrstr, str2bin, width):
+    """
+    Parses an address attribute value, for build_attributes, with str2bin
+    (such as common.ip4_str2bin) for addresses of 'width' bits.
+    A single address gives its bytes, to match exactly (or None if invalid,
+    as str2bin). Otherwise, a PrefixMatcher is returned, for,
+     - a prefix, "<address>/<length>",
+     - a comma seperated list of addresses and prefixes,
+     - "@<path>", a file listing addresses and prefixes, one per line.
+       Blank lines, and anything after a "#", are ignored.
+    Raises ValueError on a malformed prefix or list entry, and OSError if
+    the file can't be read, so a bad rule is never silently dropped.
+    """
+    if addrstr.startswith("@"):
+        with open(addrstr[1:], "r") as listfile:
+            entries = [line.partition("#")[0].strip() for line in listfile]
+        entries = [entry for entry in entries if entry]
+    elif "/" in addrstr or "," in addrstr:
+        entries = addrstr.split(",")
+    else:
+        return str2bin(addrstr)
+
+    prefixes = radix.PrefixSet(width)
+    for entry in entries:
+        address, _, length = entry.strip().partition("/")
+        address = str2bin(address)
+        if address is None:
+            raise ValueError("Malformed address {0}".format(entry))
+        try:
+            prefixes.add(address, int(length) if length else None)
+        except ValueError:
+            raise ValueError("Malformed prefix {0}".format(entry))
+    return PrefixMatcher(prefixes)
 
 
 ip_protocol_registry = {}
+ip_protocol_dispatch = {}
+
+core.register_dispatch(build_ip_protocol_dispatch)
 
 # IANA: http://www.iana.org/assignments/protocol-numbers/protocol-numbers.xhtml
 PROTO_ICMP = 1
@@ -57,3 +113,7 @@ PROTO_UDP = 17
 PROTO_IPV6 = 41
 PROTO_IPV6_ICMP = 58
 PROTO_ETHERIP = 97
+
+# Layout of the source and destination ports leading TCP and UDP headers,
+# for reading them from segments too short for the whole header.
+PORTS_HEADER = struct.Struct("!HH")
@@ -1,3 +1,7 @@
+import bisect
+import struct
+from collections import OrderedDict
+
 from .. import common
 from .. import memorymap
 
@@ -5,7 +9,7 @@ from . import ip
 from . import core
 from . import eth
 
-from .core import uint16pack, uint16unpack
+from .core import uint16pack
 
 
 
@@ -32,94 +36,220 @@ from .core import uint16pack, uint16unpack
 # Total Length is the size of the whole packet in bytes.
 # Fragment Offset is measured in terms of 8 bytes.
 
+# Layout of the fixed (20 byte) part of the header.
+IP4_HEADER = struct.Struct("!BBHHHBBH4s4s")
+
 # IPv4 flags
 IP4_FLAG_MORE_FRAGMENTS = 0b001
 IP4_FLAG_DONT_FRAGMENT = 0b010
 IP4_FLAG_EVIL_BIT = 0b100  # RFC 3514 :)
 
 
-def ip4_extract_fragment_info(fragdat):
-    frag_flags = (fragdat[0] & 0xE0) >> 5
-    frag_offset = (fragdat[0] & 0x1F) * 16 + fragdat[1]
-    return frag_flags, frag_offset
+def ip4_extract_fragment_info(flags_fragoff):
+    """Splits the flags/fragment offset field into flags and offset (in 8 bytes)."""
+    return flags_fragoff >> 13, flags_fragoff & 0x1FFF
 
 # Support for fragmented IP packets.
-fragment_trackers = {}
+# Trackers are kept in least recently used order, oldest first.
+fragment_trackers = OrderedDict()
+
+# Limits on fragment tracking, see configure_fragment_tracking.
+# Time after its last fragment a datagram is given up on, in nanoseconds.
+FRAGMENT_TIMEOUT = 30 * 10**9
+# Most datagrams tracked at once.
+FRAGMENT_MAX_TRACKERS = 8192
+# Most fragment payload bytes held by trackers at once.
+FRAGMENT_MAX_BYTES = 64 * 2**20
+
+fragment_timeout = FRAGMENT_TIMEOUT
+fragment_max_trackers = FRAGMENT_MAX_TRACKERS
+fragment_max_bytes = FRAGMENT_MAX_BYTES
+
+
+class FragmentStats:
+    """
+    Counters kept by fragment tracking.
+     - completed: Datagrams reassembled.
+     - expired: Datagrams given up on, as no fragment came within the timeout.
+     - evicted: Datagrams given up on to stay within the tracker/byte limits.
+     - overlaps: Fragments overlapping data already received (including
+       duplicates), of which only the new data was used.
+     - tracked_bytes: Fragment payload bytes currently held by trackers.
+    """
+    __slots__ = {"completed", "expired", "evicted", "overlaps", "tracked_bytes"}
+
+    def __init__(self):
+        self.completed = 0
+        self.expired = 0
+        self.evicted = 0
+        self.overlaps = 0
+        self.tracked_bytes = 0
+
+    def __str__(self):
+        return "Completed: {0}, Expired: {1}, Evicted: {2}, Overlaps: {3}, Tracked bytes: {4}".format(
+            self.completed, self.expired, self.evicted, self.overlaps, self.tracked_bytes)
+
+
+fragment_stats = FragmentStats()
+
+
+def configure_fragment_tracking(timeout=FRAGMENT_TIMEOUT, max_trackers=FRAGMENT_MAX_TRACKERS,
+                                max_bytes=FRAGMENT_MAX_BYTES):
+    """
+    Sets the limits on fragment tracking.
+     - timeout: Time (packet time, in nanoseconds) after its last fragment
+                that an incomplete datagram is given up on.
+     - max_trackers: Most datagrams tracked at once.
+     - max_bytes: Most fragment payload bytes held at once.
+    Any limit may be None for no limit. When a limit is exceeded, the least
+    recently updated datagrams are given up on first; their fragments are
+    left incomplete.
+    """
+    global fragment_timeout, fragment_max_trackers, fragment_max_bytes
+    fragment_timeout = timeout
+    fragment_max_trackers = max_trackers
+    fragment_max_bytes = max_bytes
+
+
+def drop_tracker(frag_id):
+    """Stops tracking a datagram, returning its tracker."""
+    ft = fragment_trackers.pop(frag_id)
+    fragment_stats.tracked_bytes -= ft.size
+    return ft
+
+
+def expire_trackers(now):
+    """Gives up on datagrams not updated within the timeout of time 'now'."""
+    if fragment_timeout is None:
+        return
+    while fragment_trackers:
+        frag_id, ft = next(iter(fragment_trackers.items()))
+        if now - ft.last_seen <= fragment_timeout:
+            break
+        drop_tracker(frag_id)
+        fragment_stats.expired += 1
+
+
+def evict_trackers():
+    """Gives up on the least recently updated datagrams, until within the limits."""
+    while fragment_trackers and \
+      ((fragment_max_trackers is not None and len(fragment_trackers) > fragment_max_trackers) or
+       (fragment_max_bytes is not None and fragment_stats.tracked_bytes > fragment_max_bytes)):
+        drop_tracker(next(iter(fragment_trackers)))
+        fragment_stats.evicted += 1
 
 
 class FragmentTracker:
-    """Used to track fragmented IP packets."""
-    __slots__ = {"frags", "deferred_frags", "next_offset"}
+    """
+    Used to track fragmented IP packets.
+    The payload received so far is kept as a list of non-overlapping pieces,
+    sorted by offset, each a (start, end, fragment, fragment offset) tuple
+    naming the fragment its bytes are taken from. Fragments are placed with
+    a binary search, and the datagram is complete when the pieces cover it
+    from 0 to the end of the last fragment, with no holes.
+    Overlaps are resolved in favour of the first fragment received: only the
+    parts of a fragment not yet covered are used, so duplicates are ignored.
+    """
+    __slots__ = {"frags", "starts", "pieces", "covered", "total_length", "last_seen", "size"}
 
     def __init__(self):
+        # Every fragment received, in order of arrival.
         self.frags = []
-        self.deferred_frags = []
-        self.next_offset = 0
+        # Start offsets of the pieces, for bisect.
+        self.starts = []
+        self.pieces = []
+        # Bytes covered by the pieces.
+        self.covered = 0
+        # Length of the datagram payload, known once the last fragment is seen.
+        self.total_length = None
+        self.last_seen = 0
+        self.size = 0
 
     def add_fragment(self, frag):
         """Returns True if packet is complete, False if otherwise."""
-        ir = self.try_insert(frag)
-        if ir is None:
-            # Tracking complete!
-            return True
-        elif ir is True:
-
-            # Tracking incomplete, but we've advanced.
-            # We can try and redo any deferred packets here.
-            try_again = True
-            while try_again:
-                try_again = False
-                # copy deferred list.
-                current_deferred = self.deferred_frags[:]
-                # clear main list.
-                self.deferred_frags.clear()
-
-                # Iterate over deferred list.
-                for frag in current_deferred:
-                    tr = self.try_insert(frag)
-
-                    if tr is None:
-                        # Tracking complete!
-                        return True
-
-                    elif tr is True:
-                        try_again = True
-
-        return False
-
-    def try_insert(self, frag):
+        self.size += frag.payload_length
+        fragment_stats.tracked_bytes += frag.payload_length
+        self.frags.append(frag)
+
+        frag_flags, frag_offset, _ = frag.get_fraginfo()
+        frag_end = frag_offset + max(0, frag.payload_length)
+
+        if (frag_flags & IP4_FLAG_MORE_FRAGMENTS) == 0:
+            if self.total_length is None:
+                self.total_length = frag_end
+            elif self.total_length != frag_end:
+                # Conflicting last fragments, the first one stands.
+                fragment_stats.overlaps += 1
+
+        if self.insert(frag_offset, frag_end, frag):
+            fragment_stats.overlaps += 1
+
+        return self.total_length is not None and self.covered == self.total_length and \
+            self.pieces[-1][1] == self.total_length
+
+    def insert(self, start, end, frag):
         """
-        Try to add a fragment to the frags list.
-        Tristate return:
-         - None  = last fragment added.
-         - True  = fragment added, more needed.
-         - False = fragment deferred.
+        Adds the parts of the range [start, end) of a fragment that are not
+        already covered as pieces. Returns True if any part was already covered.
         """
-        frag_flags, frag_offset, _ = frag.get_fraginfo()
-        if frag_offset == self.next_offset:
-            self.frags.append(frag)
-            self.next_offset += frag.payload_length
-            if (frag_flags & IP4_FLAG_MORE_FRAGMENTS) == 0:
-                # Fragment tracking finished!
-                return None
-            # Successfully inserted.
-            return True
-        else:
-            self.deferred_frags.append(frag)
-            # Added to deferred pool.
-            return False
+        frag_offset = start
+        overlapped = False
+
+        # The piece before may extend into the range.
+        idx = bisect.bisect_right(self.starts, start)
+        if idx > 0 and self.pieces[idx - 1][1] > start:
+            start = self.pieces[idx - 1][1]
+            overlapped = True
+
+        while start < end:
+            if idx < len(self.pieces) and self.pieces[idx][0] < end:
+                # A following piece covers part of the range, fill the gap before it.
+                piece_start, piece_end = self.pieces[idx][0], self.pieces[idx][1]
+                if piece_start > start:
+                    self.add_piece(idx, start, piece_start, frag, frag_offset)
+                    idx += 1
+                overlapped = True
+                start = max(start, piece_end)
+                idx += 1
+            else:
+                self.add_piece(idx, start, end, frag, frag_offset)
+                start = end
+
+        return overlapped
+
+    def add_piece(self, idx, start, end, frag, frag_offset):
+        """Inserts a piece at index idx of the piece list."""
+        self.starts.insert(idx, start)
+        self.pieces.insert(idx, (start, end, frag, frag_offset))
+        self.covered += end - start
+
+    def views(self):
+        """Returns memoryviews of the payload, in order, from the pieces."""
+        views = []
+        for start, end, frag, frag_offset in self.pieces:
+            offset = frag.payload_offset - frag_offset
+            views.append(frag.data[offset + start:offset + end])
+        return views
+
 
 class IPv4(core.CarrierProtocol):
     name = "ip4"
 
-    __slots__ = {"payload_offset", "payload_length", "payload_end"
-                 "_ver_ihl", "_tos", "_len",
-                 "_id", "_flags_fragoff",
-                 "_ttl", "_proto", "_chksum",
-                 "_saddr",
-                 "_daddr",
+    __slots__ = {"payload_offset", "payload_length", "payload_end",
                  "logical_payload_length"}
 
+    header_fields = ("ver_ihl", "tos", "len", "id", "flags_fragoff",
+                     "ttl", "protocol", "checksum", "saddr", "daddr")
+    attribute_fields = ("protocol", "saddr", "daddr")
+    unordered_fields = ("saddr", "daddr")
+
+    # Fixed fields, for writing. Fields are read with get_header.
+    _ttl = 8
+    _proto = 9
+    _chksum = slice(10, 12)
+    _saddr = slice(12, 16)
+    _daddr = slice(16, 20)
+
     def __init__(self, data, prev):
         """"""
         super().__init__(data, prev)
@@ -132,38 +262,37 @@ class IPv4(core.CarrierProtocol):
         self._calculate_offsets()
 
     def _calculate_offsets(self):
-        """"""
-        # Fixed offsets
-        self._ver_ihl = 0
-        self._tos = 1
-        self._len = slice(2, 4)
-        self._id = slice(4, 6)
-        self._flags_fragoff = slice(6, 8)
-        self._ttl = 8
-        self._proto = 9
-        self._chksum = slice(10, 12)
-        self._saddr = slice(12, 16)
-        self._daddr = slice(16, 20)
+        """Calculates the offsets of the payload."""
+        ver_ihl, _, total_length = core.unpack_from(IP4_HEADER, self.data)[:3]
 
         # Get header length.
-        ihl = self.data[self._ver_ihl] & 0x0F
+        ihl = ver_ihl & 0x0F
 
         self.payload_offset = (ihl * 4)  # IHL is in terms of 4 bytes.
-        self.payload_end = uint16unpack(self.data[self._len])
+        self.payload_end = total_length
         self.payload_length = self.payload_end - self.payload_offset
         self.logical_payload_length = self.payload_length
 
+    def get_header(self):
+        """
+        Decodes the fixed header fields, returning a (ver_ihl, tos, len, id,
+        flags_fragoff, ttl, protocol, checksum, saddr, daddr) tuple.
+        """
+        return core.unpack_from(IP4_HEADER, self.data)
+
     def get_protocol(self):
         """Returns the protocl number of this IP header."""
         return self.data[self._proto]
 
     # Used by the interpreter/fragment tracker.
     def get_fraginfo(self):
-        """Returns the flags, fragment offset and fragment ident."""
-        fragdat = self.data[self._flags_fragoff]
-        frag_flags, frag_offset = ip4_extract_fragment_info(fragdat)
-        frag_id = self.get_route() + bytes(self.data[self._id]) + bytes(self.get_protocol(),)
-        return frag_flags, frag_offset*8, frag_id
+        """
+        Returns the flags, fragment offset and fragment ident.
+        The ident is a (saddr, daddr, id, protocol) tuple.
+        """
+        _, _, _, ident, flags_fragoff, _, protonum, _, saddr, daddr = self.get_header()
+        frag_flags, frag_offset = ip4_extract_fragment_info(flags_fragoff)
+        return frag_flags, frag_offset*8, (saddr, daddr, ident, protonum)
 
     def get_route(self):
         """Returns the route defined by this IP header."""
@@ -177,12 +306,17 @@ class IPv4(core.CarrierProtocol):
         """Returns the (possibly logical) payload length."""
         return self.logical_payload_length
 
+    def compactable(self):
+        """Fragments, with the logical length of their datagram, are not compactable."""
+        return self.logical_payload_length == self.payload_length
+
     def get_attributes(self):
         """Retrieve a set of attributes describing fields in this protocol."""
+        header = self.get_header()
         return {
-            "protocol": self.data[self._proto],
-            "saddr": bytes(self.data[self._saddr]),
-            "daddr": bytes(self.data[self._daddr])
+            "protocol": header[6],
+            "saddr": header[8],
+            "daddr": header[9]
         }
 
     def set_attributes(self, attrs):
@@ -202,6 +336,9 @@ class IPv4(core.CarrierProtocol):
         if daddr in ipmap:
             self.data[self._daddr] = ipmap[daddr]
 
+        if saddr in ipmap or daddr in ipmap:
+            self.invalidate_attributes()
+
         if self.next is not None:
             self.next.replace_hosts(hostmap)
 
@@ -218,6 +355,7 @@ class IPv4(core.CarrierProtocol):
     def reset_state():
         """Resets the fragment_trackers dict."""
         fragment_trackers.clear()
+        fragment_stats.tracked_bytes = 0
 
     # IPv4 attrstr format.
     # <attr> = <key> "=" <value>
@@ -225,9 +363,13 @@ class IPv4(core.CarrierProtocol):
     #
     # Attributes are seperated by semicolons, which contain colon-seperated key-value pairs.
     # Valid keys are saddr, daddr, protocol
+    # Addresses may also be prefixes, lists, or files, see ip.build_address_attribute.
     @staticmethod
     def build_attributes(attrstr):
-        """Creates a set of attributes from an attribute string."""
+        """
+        Creates a set of attributes from an attribute string.
+        Raises ValueError (or OSError) for a malformed address attribute.
+        """
         attrdict = {}
 
         attrs = attrstr.split(";")
@@ -235,14 +377,15 @@ class IPv4(core.CarrierProtocol):
             try:
                 # Split into kvp.
                 k, v = attr.split("=")
-
-                if k == "saddr" or k == "daddr":
-                    attrdict[k] = common.ip4_str2bin(v)
-                elif k == "protocol":
-                    attrdict["protocol"] = common.parse_int(v)
             except ValueError:
                 # Skip malformed attribute.
-                pass
+                continue
+
+            if k == "saddr" or k == "daddr":
+                # Bad prefixes and lists raise, see ip.build_address_attribute.
+                attrdict[k] = ip.build_address_attribute(v, common.ip4_str2bin, 32)
+            elif k == "protocol":
+                attrdict["protocol"] = common.parse_int(v)
 
         return attrdict
 
@@ -265,33 +408,38 @@ class IPv4(core.CarrierProtocol):
             # Packet is fragmented!
             instance.completed = False
 
+            # Give up on datagrams that have timed out.
+            now = core.packet_time
+            expire_trackers(now)
+
             if frag_id not in fragment_trackers:
                 fragment_trackers[frag_id] = FragmentTracker()
+            else:
+                # Mark as most recently used.
+                fragment_trackers.move_to_end(frag_id)
 
             # Get the fragment tracker.
             ft = fragment_trackers[frag_id]
+            ft.last_seen = now
 
             # Add this fragment to the tracker.
             ft_complete = ft.add_fragment(instance)
 
             if ft_complete:
                 # Fragmented packet is complete!
-                del fragment_trackers[frag_id]
-                views = []
+                drop_tracker(frag_id)
+                fragment_stats.completed += 1
 
-                logical_length = 0
+                logical_length = ft.total_length
                 for frag in ft.frags:
-                    logical_length += frag.payload_length
-                    frag.completed = True
-                    # Add payload memoryview to views list.
-                    views.append(
-                        frag.data[frag.payload_offset:frag.payload_end]
-                    )
+                    core.mark_completed(frag)
+
                 # Determine protocol (based off protocol number of last packet)
+                next = None
                 protocol = ip.lookup_ip_protocol(protonum)
                 if protocol is not None:
                     # Define payload view.
-                    mapped_data = memorymap.memorymap(views)
+                    mapped_data = memorymap.memorymap(ft.views())
                     # Interpret payload.
                     next = protocol.interpret_packet(mapped_data, instance)
 
@@ -299,16 +447,16 @@ class IPv4(core.CarrierProtocol):
                 for frag in ft.frags:
                     frag.next = next
                     frag.logical_payload_length = logical_length
+            else:
+                evict_trackers()
 
         else:
             # No fragmentation!
             # Determine protocol.
             protocol = ip.lookup_ip_protocol(protonum)
             if protocol is not None:
-                # Define payload view.
-                payload = instance.data[instance.payload_offset:instance.payload_end]
                 # Interpret payload.
-                instance.next = protocol.interpret_packet(payload, instance)
+                instance.interpret_next(protocol, instance.payload_offset, instance.payload_end)
         return instance
 
 
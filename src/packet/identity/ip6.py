@@ -1,10 +1,11 @@
+import struct
+
 from .. import common
 
 from . import ip
 from . import core
 from . import eth
 
-from .core import uint16pack, uint16unpack
 
 # IPv6 header format:
 #
@@ -30,14 +31,24 @@ from .core import uint16pack, uint16unpack
 # |                                                               |
 # +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
 
+# Layout of the (40 byte) header.
+IP6_HEADER = struct.Struct("!IHBB16s16s")
+
+
 class IPv6(core.CarrierProtocol):
     name = "ip6"
 
-    __slots__ = {"payload_offset", "payload_length",
-                 "_ver_tc_flow",
-                 "_paylen", "_next", "_hoplim",
-                 "_saddr",
-                 "_daddr"}
+    __slots__ = {"payload_offset", "payload_length"}
+
+    header_fields = ("ver_tc_flow", "payload_length", "protocol", "hop_limit", "saddr", "daddr")
+    attribute_fields = ("protocol", "saddr", "daddr")
+    unordered_fields = ("saddr", "daddr")
+
+    # Fixed fields, for writing. Fields are read with get_header.
+    _nexthdr = 6
+    _hoplim = 7
+    _saddr = slice(8, 24)
+    _daddr = slice(24, 40)
 
     def __init__(self, data, prev):
         super().__init__(data, prev)
@@ -45,22 +56,23 @@ class IPv6(core.CarrierProtocol):
         if len(data) < 40:
             raise core.ProtocolFormatError("Truncated IPv6 header")
 
-        self._calculate_checksums()
-
-    def _calculate_checksums(self):
-        self._ver_tc_flow = slice(0, 4)
-        self._paylen = slice(4, 6)
-        self._next = 6
-        self._hoplim = 7
-        self._saddr = slice(8, 24)
-        self._daddr = slice(24, 40)
+        self._calculate_offsets()
 
+    def _calculate_offsets(self):
+        """Calculates the offsets of the payload."""
         self.payload_offset = 40
-        self.payload_length = uint16unpack(self.data[self._paylen])
+        self.payload_length = core.unpack_from(IP6_HEADER, self.data)[1]
+
+    def get_header(self):
+        """
+        Decodes the header fields, returning a (ver_tc_flow, payload_length,
+        protocol, hop_limit, saddr, daddr) tuple, protocol being the next header.
+        """
+        return core.unpack_from(IP6_HEADER, self.data)
 
     def get_protocol(self):
         """Returns the protocl number (next header) of this IPv6 header."""
-        return self.data[self._next]
+        return self.data[self._nexthdr]
 
     def get_route(self):
         """Returns the route defined by this IPv6 header."""
@@ -76,10 +88,11 @@ class IPv6(core.CarrierProtocol):
 
     def get_attributes(self):
         """Retrieve a set of attributes describing fields in this protocol."""
+        header = self.get_header()
         return {
-            "protocol": self.data[self._next],
-            "saddr": bytes(self.data[self._saddr]),
-            "daddr": bytes(self.data[self._daddr])
+            "protocol": header[2],
+            "saddr": header[4],
+            "daddr": header[5]
         }
 
     def set_attributes(self, attrs):
@@ -99,6 +112,9 @@ class IPv6(core.CarrierProtocol):
         if daddr in ipmap:
             self.data[self._daddr] = ipmap[daddr]
 
+        if saddr in ipmap or daddr in ipmap:
+            self.invalidate_attributes()
+
         if self.next is not None:
             self.next.replace_hosts(hostmap)
 
@@ -108,9 +124,13 @@ class IPv6(core.CarrierProtocol):
     #
     # Attributes are seperated by semicolons, which contain colon-seperated key-value pairs.
     # Valid keys are saddr, daddr, protocol
+    # Addresses may also be prefixes, lists, or files, see ip.build_address_attribute.
     @staticmethod
     def build_attributes(attrstr):
-        """Creates a set of attributes from an attribute string."""
+        """
+        Creates a set of attributes from an attribute string.
+        Raises ValueError (or OSError) for a malformed address attribute.
+        """
         attrdict = {}
 
         attrs = attrstr.split(";")
@@ -118,14 +138,15 @@ class IPv6(core.CarrierProtocol):
             try:
                 # Split into kvp.
                 k, v = attr.split("=")
-
-                if k == "saddr" or k == "daddr":
-                    attrdict[k] = common.ip6_str2bin(v)
-                elif k == "protocol":
-                    attrdict["protocol"] = common.parse_int(v)
             except ValueError:
                 # Skip malformed attribute.
-                pass
+                continue
+
+            if k == "saddr" or k == "daddr":
+                # Bad prefixes and lists raise, see ip.build_address_attribute.
+                attrdict[k] = ip.build_address_attribute(v, common.ip6_str2bin, 128)
+            elif k == "protocol":
+                attrdict["protocol"] = common.parse_int(v)
 
         return attrdict
 
@@ -143,11 +164,9 @@ class IPv6(core.CarrierProtocol):
 
         protocol = ip.lookup_ip_protocol(protonum)
         if protocol is not None:
-            # Define payload view.
-            payload_end = instance.payload_offset + instance.payload_length
-            payload = instance.data[instance.payload_offset:payload_end]
             # Interpret payload.
-            instance.next = protocol.interpret_packet(payload, instance)
+            payload_end = instance.payload_offset + instance.payload_length
+            instance.interpret_next(protocol, instance.payload_offset, payload_end)
 
         return instance
 
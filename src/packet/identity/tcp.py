@@ -1,9 +1,11 @@
+import struct
+
 from .. import common
 
 from . import core
 from . import ip
 
-from .core import uint16pack, uint16unpack, uint32pack, uint32unpack
+from .core import uint16pack, uint32pack
 
 # RFC 793: Transmission Control Protocol.
 
@@ -27,6 +29,9 @@ from .core import uint16pack, uint16unpack, uint32pack, uint32unpack
 # |                             data                              |
 # +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
 
+# Layout of the fixed (20 byte) part of the header.
+TCP_HEADER = struct.Struct("!HHIIBBHHH")
+
 tcp_routes = {}
 
 class TCPStateMachine:
@@ -39,12 +44,16 @@ class TCPStateMachine:
 class TCP(core.CarrierProtocol):
     name = "tcp"
 
-    __slots__ = {"payload_offset", "port",
-                 "_sport", "_dport",
-                 "_seqnum",
-                 "_acknum",
-                 "_offset_byte", "_flags_byte", "_window"
-                 "_chksum", "_urgptr"}
+    __slots__ = {"payload_offset", "port"}
+
+    header_fields = ("sport", "dport", "seqnum", "acknum", "offset_byte",
+                     "flags_byte", "window", "checksum", "urgptr")
+    attribute_fields = ("port", "sport", "dport")
+    unordered_fields = ("port",)
+
+    # Fixed fields, for writing. Fields are read with get_header.
+    _offset_byte = 12
+    _chksum = slice(16, 18)
 
     def __init__(self, data, prev):
         super().__init__(data, prev)
@@ -52,26 +61,24 @@ class TCP(core.CarrierProtocol):
         self.port = None
 
     def _calculate_offsets(self):
-        self._sport = slice(0, 2)
-        self._dport = slice(2, 4)
-        self._seqnum = slice(4, 8)
-        self._acknum = slice(8, 12)
-        self._offset_byte = 12
-        self._flags_byte = 13
-        self._window = slice(14, 16)
-        self._chksum = slice(16, 18)
-        self._urgptr = slice(18, 20)
-
+        """Calculates the offset of the payload."""
         # Data offset is in multiples of 4.
         self.payload_offset = ((self.data[self._offset_byte] & 0xF0) >> 2)
 
+    def get_header(self):
+        """
+        Decodes the fixed header fields, returning a (sport, dport, seqnum,
+        acknum, offset_byte, flags_byte, window, checksum, urgptr) tuple.
+        """
+        return core.unpack_from(TCP_HEADER, self.data)
 
     def get_attributes(self):
         """Retrieve a set of attributes describing fields in this protocol."""
+        sport, dport = core.unpack_from(ip.PORTS_HEADER, self.data)
         return {
             "port": self.port,
-            "sport": uint16unpack(self.data[self._dport]),
-            "dport": uint16unpack(self.data[self._sport])
+            "sport": sport,
+            "dport": dport
         }
 
     def set_attributes(self, attrs):
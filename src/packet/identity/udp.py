@@ -1,9 +1,11 @@
+import struct
+
 from .. import common
 
 from . import core
 from . import ip
 
-from .core import uint16pack, uint16unpack, uint32pack, uint32unpack
+from .core import uint16pack, uint32pack
 
 # RFC 768: User Datagram Protocol
 
@@ -24,11 +26,20 @@ from .core import uint16pack, uint16unpack, uint32pack, uint32unpack
 # Minimum size of a valid UDP header.
 UDP_MIN_SIZE = 8
 
+# Layout of the header.
+UDP_HEADER = struct.Struct("!HHHH")
+
 
 class UDP(core.CarrierProtocol):
     name = "udp"
 
-    __slots__ = {"payload_length", "payload_offset", "_sport", "_dport", "_len", "_chksum"}
+    __slots__ = {"payload_length", "payload_offset"}
+
+    header_fields = ("sport", "dport", "length", "checksum")
+    attribute_fields = ("sport", "dport")
+
+    # Fixed fields, for writing. Fields are read with get_header.
+    _chksum = slice(6, 8)
 
     def __init__(self, data, prev):
         super().__init__(data, prev)
@@ -38,20 +49,20 @@ class UDP(core.CarrierProtocol):
         self._calculate_offsets()
 
     def _calculate_offsets(self):
-        # Fixed offsets.
-        self._sport = slice(0, 2)
-        self._dport = slice(2, 4)
-        self._len = slice(4, 6)
-        self._chksum = slice(6, 8)
-
-        self.payload_length = uint16unpack(self.data[self._len])
+        """Calculates the offset and length of the payload."""
+        self.payload_length = self.get_header()[2]
         self.payload_offset = 8
 
+    def get_header(self):
+        """Decodes the header, returning a (sport, dport, length, checksum) tuple."""
+        return core.unpack_from(UDP_HEADER, self.data)
+
     def get_attributes(self):
         """Retrieve a set of attributes describing fields in this protocol."""
+        sport, dport = core.unpack_from(ip.PORTS_HEADER, self.data)
         return {
-            "sport": uint16unpack(self.data[self._dport]),
-            "dport": uint16unpack(self.data[self._sport])
+            "sport": sport,
+            "dport": dport
         }
 
     def set_attributes(self, attrs):
@@ -105,7 +116,7 @@ class UDP(core.CarrierProtocol):
                 k, v = attr.split("=")
 
                 if k == "sport" or k == "dport":
-                    attrdict[k] = common.interpret_int(v)
+                    attrdict[k] = common.parse_int(v)
 
             except ValueError:
                 # Skip malformed attribute.
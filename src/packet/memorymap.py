@@ -151,6 +151,14 @@ for a given virtual index. Has a complexity of O(log n)"""
 or returns a memorymap in the given range."""
         # If idx is a slice...
         if isinstance(idx, slice):
+            # Slices within one segment are simply a slice of that segment,
+            # which supports the buffer interface (e.g. for struct).
+            start, end, step = idx.indices(len(self))
+            if step == 1 and start < end:
+                segidx, locidx = self._map_idx(start)
+                seg = self.segments[segidx]
+                if end <= seg.end:
+                    return seg.mem[locidx:locidx + end - start]
             return memorymap(self, slc=idx)
         else:
             # Get indexes.
@@ -166,7 +174,7 @@ or returns a memorymap in the given range."""
         # If idx is a slice...
         if isinstance(idx, slice):
             # For slice assignment, val should be iterable.
-            if not isinstance(val, collections.Iterable):
+            if not isinstance(val, collections.abc.Iterable):
                 raise TypeError("Value is not iterable.")
 
             # Check the range of the slice,
@@ -188,6 +196,11 @@ or returns a memorymap in the given range."""
             self.segments[segidx].mem[locidx] = val
 
 
+    def __bytes__(self):
+        """Returns a copy of the logical memory map's contents."""
+        return b"".join(seg.mem for seg in self.segments)
+
+
     def __delitem__(self, idx):
         """Deleting items is not allowed."""
         raise TypeError("Cannot delete item.")
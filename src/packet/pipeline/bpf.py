@@ -0,0 +1,678 @@
+"""
+bpf: classic BPF programs, run on packet data before identification.
+A BPFProgram is built from a list of (code, jt, jf, k) instructions, as
+printed by 'tcpdump -ddd' (or '-dd'), see parse_bpf, or from a small
+tcpdump-like filter language, see compile_filter. The instructions are
+checked and turned into tuples once, so running a program is a loop over
+tuples, with struct loads from the packet data.
+prefilter is the pipeline stage, dropping packets a program rejects before
+they are identified.
+"""
+
+import re
+import struct
+import operator
+import ipaddress
+
+from .. import common
+from . import expression
+
+# Instruction classes.
+BPF_LD = 0x00
+BPF_LDX = 0x01
+BPF_ST = 0x02
+BPF_STX = 0x03
+BPF_ALU = 0x04
+BPF_JMP = 0x05
+BPF_RET = 0x06
+BPF_MISC = 0x07
+
+# Load sizes.
+BPF_W = 0x00
+BPF_H = 0x08
+BPF_B = 0x10
+
+# Load modes.
+BPF_IMM = 0x00
+BPF_ABS = 0x20
+BPF_IND = 0x40
+BPF_MEM = 0x60
+BPF_LEN = 0x80
+BPF_MSH = 0xa0
+
+# ALU operations.
+BPF_ADD = 0x00
+BPF_SUB = 0x10
+BPF_MUL = 0x20
+BPF_DIV = 0x30
+BPF_OR = 0x40
+BPF_AND = 0x50
+BPF_LSH = 0x60
+BPF_RSH = 0x70
+BPF_NEG = 0x80
+BPF_MOD = 0x90
+BPF_XOR = 0xa0
+
+# Jumps.
+BPF_JA = 0x00
+BPF_JEQ = 0x10
+BPF_JGT = 0x20
+BPF_JGE = 0x30
+BPF_JSET = 0x40
+
+# Operand sources.
+BPF_K = 0x00
+BPF_X = 0x08
+BPF_A = 0x10
+
+# Miscellaneous operations.
+BPF_TAX = 0x00
+BPF_TXA = 0x80
+
+# Number of scratch memory words.
+BPF_MEMWORDS = 16
+
+# Largest conditional jump offset, jt and jf being 8 bit fields.
+BPF_MAXJUMP = 255
+
+# Value returned by compiled filters for accepted packets, as tcpdump's.
+BPF_ACCEPT = 262144
+
+# Operations of precompiled instructions, roughly by how often they run.
+OP_JUMP_K = 0
+OP_LOAD_ABS = 1
+OP_RET_K = 2
+OP_LOADX_MSH = 3
+OP_LOAD_IND = 4
+OP_ALU_K = 5
+OP_JUMP = 6
+OP_JUMP_X = 7
+OP_ALU_X = 8
+OP_LOAD_IMM = 9
+OP_LOAD_LEN = 10
+OP_LOAD_MEM = 11
+OP_LOADX_IMM = 12
+OP_LOADX_LEN = 13
+OP_LOADX_MEM = 14
+OP_STORE = 15
+OP_STOREX = 16
+OP_NEG = 17
+OP_TAX = 18
+OP_TXA = 19
+OP_RET_A = 20
+OP_RET_X = 21
+
+LOADS = {
+    BPF_W: struct.Struct("!I").unpack_from,
+    BPF_H: struct.Struct("!H").unpack_from,
+    BPF_B: struct.Struct("!B").unpack_from,
+}
+
+ALU_OPERATIONS = {
+    BPF_ADD: operator.add,
+    BPF_SUB: operator.sub,
+    BPF_MUL: operator.mul,
+    BPF_DIV: operator.floordiv,
+    BPF_OR: operator.or_,
+    BPF_AND: operator.and_,
+    BPF_LSH: operator.lshift,
+    BPF_RSH: operator.rshift,
+    BPF_MOD: operator.mod,
+    BPF_XOR: operator.xor,
+}
+
+# Shifts by X, which is only known when the program runs. Shifts of 32
+# bits or more give 0, rather than growing a Python int before masking.
+ALU_X_OPERATIONS = dict(ALU_OPERATIONS)
+ALU_X_OPERATIONS[BPF_LSH] = lambda a, x: a << x if x < 32 else 0
+ALU_X_OPERATIONS[BPF_RSH] = lambda a, x: a >> x if x < 32 else 0
+
+JUMP_CONDITIONS = {
+    BPF_JEQ: operator.eq,
+    BPF_JGT: operator.gt,
+    BPF_JGE: operator.ge,
+    BPF_JSET: lambda a, k: (a & k) != 0,
+}
+
+
+class BPFError(ValueError):
+    """Exception raised for an invalid BPF program or filter."""
+    pass
+
+
+class BPFProgram:
+    """
+    A checked and precompiled classic BPF program.
+     - code: The (code, jt, jf, k) instructions given.
+     - instructions: Precompiled instruction tuples. Jump targets are
+                     absolute, and loads carry their struct function.
+     - uses_memory: True if the program uses scratch memory.
+    run returns the program's result for a packet, 0 meaning reject.
+    As in the kernel, loads past the end of the data, and division
+    by zero, reject the packet. Shifts by X of 32 bits or more give 0.
+    """
+    __slots__ = {"code", "instructions", "uses_memory"}
+
+    def __init__(self, code):
+        self.code = [tuple(insn) for insn in code]
+        self.uses_memory = False
+        self.instructions = [self._precompile(pc, *insn) for pc, insn in enumerate(self.code)]
+        if not self.instructions:
+            raise BPFError("Empty BPF program.")
+
+    def __reduce__(self):
+        """Pickles the program as its instructions, for worker processes."""
+        return (BPFProgram, (self.code,))
+
+    def _precompile(self, pc, code, jt, jf, k):
+        """Checks an instruction, returning its precompiled tuple."""
+        cls = code & 0x07
+        size = code & 0x18
+        mode = code & 0xe0
+        k &= 0xFFFFFFFF
+
+        if cls == BPF_LD:
+            if mode == BPF_ABS and size in LOADS:
+                return (OP_LOAD_ABS, LOADS[size], k)
+            if mode == BPF_IND and size in LOADS:
+                return (OP_LOAD_IND, LOADS[size], k)
+            if mode == BPF_IMM and size == BPF_W:
+                return (OP_LOAD_IMM, k)
+            if mode == BPF_LEN and size == BPF_W:
+                return (OP_LOAD_LEN,)
+            if mode == BPF_MEM and size == BPF_W:
+                return (OP_LOAD_MEM, self._memory(k))
+        elif cls == BPF_LDX:
+            if mode == BPF_IMM and size == BPF_W:
+                return (OP_LOADX_IMM, k)
+            if mode == BPF_LEN and size == BPF_W:
+                return (OP_LOADX_LEN,)
+            if mode == BPF_MEM and size == BPF_W:
+                return (OP_LOADX_MEM, self._memory(k))
+            if mode == BPF_MSH and size == BPF_B:
+                return (OP_LOADX_MSH, k)
+        elif cls == BPF_ST and code == BPF_ST:
+            return (OP_STORE, self._memory(k))
+        elif cls == BPF_STX and code == BPF_STX:
+            return (OP_STOREX, self._memory(k))
+        elif cls == BPF_ALU:
+            op = code & 0xf0
+            if op == BPF_NEG:
+                return (OP_NEG,)
+            if op in ALU_OPERATIONS:
+                if code & BPF_X:
+                    return (OP_ALU_X, ALU_X_OPERATIONS[op])
+                if op in (BPF_DIV, BPF_MOD) and k == 0:
+                    raise BPFError("Division by zero at instruction {0}.".format(pc))
+                if op in (BPF_LSH, BPF_RSH) and k >= 32:
+                    raise BPFError("Shift by {0} at instruction {1}.".format(k, pc))
+                return (OP_ALU_K, ALU_OPERATIONS[op], k)
+        elif cls == BPF_JMP:
+            op = code & 0xf0
+            if op == BPF_JA:
+                return (OP_JUMP, self._target(pc, k))
+            if op in JUMP_CONDITIONS:
+                if not (0 <= jt <= BPF_MAXJUMP and 0 <= jf <= BPF_MAXJUMP):
+                    raise BPFError("Jump offset out of range at instruction {0}.".format(pc))
+                jt = self._target(pc, jt)
+                jf = self._target(pc, jf)
+                if code & BPF_X:
+                    return (OP_JUMP_X, JUMP_CONDITIONS[op], jt, jf)
+                return (OP_JUMP_K, JUMP_CONDITIONS[op], k, jt, jf)
+        elif cls == BPF_RET:
+            rval = code & 0x18
+            if rval == BPF_K:
+                return (OP_RET_K, k)
+            if rval == BPF_A:
+                return (OP_RET_A,)
+            if rval == BPF_X:
+                return (OP_RET_X,)
+        elif cls == BPF_MISC:
+            if code & 0xf8 == BPF_TAX:
+                return (OP_TAX,)
+            if code & 0xf8 == BPF_TXA:
+                return (OP_TXA,)
+
+        raise BPFError("Invalid instruction {0} at {1}.".format(code, pc))
+
+    def _memory(self, k):
+        """Checks a scratch memory index."""
+        if k >= BPF_MEMWORDS:
+            raise BPFError("Scratch memory index {0} out of range.".format(k))
+        self.uses_memory = True
+        return k
+
+    def _target(self, pc, offset):
+        """Checks a (forward) jump offset, returning the absolute target."""
+        target = pc + 1 + offset
+        if target >= len(self.code):
+            raise BPFError("Jump out of range at instruction {0}.".format(pc))
+        return target
+
+    def run(self, data, length):
+        """
+        Runs the program over packet data (bytes, bytearray or memoryview),
+        'length' being the original length of the packet.
+        Returns the program's result, 0 if the packet is rejected.
+        """
+        instructions = self.instructions
+        memory = [0] * BPF_MEMWORDS if self.uses_memory else None
+        a = 0
+        x = 0
+        pc = 0
+
+        try:
+            while True:
+                insn = instructions[pc]
+                op = insn[0]
+                pc += 1
+
+                if op == OP_JUMP_K:
+                    pc = insn[3] if insn[1](a, insn[2]) else insn[4]
+                elif op == OP_LOAD_ABS:
+                    a = insn[1](data, insn[2])[0]
+                elif op == OP_RET_K:
+                    return insn[1]
+                elif op == OP_LOADX_MSH:
+                    x = (data[insn[1]] & 0x0f) << 2
+                elif op == OP_LOAD_IND:
+                    a = insn[1](data, (x + insn[2]) & 0xFFFFFFFF)[0]
+                elif op == OP_ALU_K:
+                    a = insn[1](a, insn[2]) & 0xFFFFFFFF
+                elif op == OP_JUMP:
+                    pc = insn[1]
+                elif op == OP_JUMP_X:
+                    pc = insn[2] if insn[1](a, x) else insn[3]
+                elif op == OP_ALU_X:
+                    a = insn[1](a, x) & 0xFFFFFFFF
+                elif op == OP_LOAD_IMM:
+                    a = insn[1]
+                elif op == OP_LOAD_LEN:
+                    a = length
+                elif op == OP_LOAD_MEM:
+                    a = memory[insn[1]]
+                elif op == OP_LOADX_IMM:
+                    x = insn[1]
+                elif op == OP_LOADX_LEN:
+                    x = length
+                elif op == OP_LOADX_MEM:
+                    x = memory[insn[1]]
+                elif op == OP_STORE:
+                    memory[insn[1]] = a
+                elif op == OP_STOREX:
+                    memory[insn[1]] = x
+                elif op == OP_NEG:
+                    a = -a & 0xFFFFFFFF
+                elif op == OP_TAX:
+                    x = a
+                elif op == OP_TXA:
+                    a = x
+                elif op == OP_RET_A:
+                    return a
+                else:
+                    return x
+        except (struct.error, IndexError, ZeroDivisionError):
+            # Load out of bounds, or division by zero.
+            return 0
+
+    def dump(self):
+        """Returns the program in 'tcpdump -ddd' form."""
+        lines = [str(len(self.code))]
+        lines.extend("{0} {1} {2} {3}".format(*insn) for insn in self.code)
+        return "\n".join(lines)
+
+
+def parse_bpf(text):
+    """
+    Parses a BPF program in the form printed by 'tcpdump -ddd' (an
+    instruction count, then a 'code jt jf k' line per instruction) or
+    'tcpdump -dd' (C array initialisers), returning a BPFProgram.
+    """
+    code = []
+    count = None
+    for number, line in enumerate(text.splitlines()):
+        values = [int(value, 0) for value in re.findall(r"0[xX][0-9a-fA-F]+|\d+", line)]
+        if not values:
+            continue
+        if len(values) == 4:
+            code.append(values)
+        elif len(values) == 1 and count is None and not code:
+            count = values[0]
+        else:
+            raise BPFError("Malformed BPF instruction on line {0}.".format(number + 1))
+
+    if count is not None and count != len(code):
+        raise BPFError("Expected {0} BPF instructions, found {1}.".format(count, len(code)))
+    return BPFProgram(code)
+
+
+# Filter compiler.
+#
+# compile_filter accepts a small subset of the tcpdump filter language,
+# for Ethernet frames:
+# <filter> ::= <and> | <and> "or" <filter>
+# <and> ::= <not> | <not> "and" <and>
+# <not> ::= <primitive> | "not" <not> | "(" <filter> ")"
+# <primitive> ::= <protocol>
+#               | [<protocol>] [<dir>] "host" <address>
+#               | [<protocol>] [<dir>] "net" <prefix>
+#               | [<protocol>] [<dir>] "port" <number>
+#               | [<protocol>] [<dir>] "portrange" <number> "-" <number>
+#               | "len" <op> <number> | "greater" <number> | "less" <number>
+# <protocol> ::= "ip" | "ip6" | "arp" | "tcp" | "udp" | "icmp" | "icmp6"
+# <dir> ::= "src" | "dst"
+#
+# Filters are first built as trees of tuples,
+#   ("and", a, b), ("or", a, b), ("not", a),
+#   ("test", loads, jump code, k): run the load instructions, then test A.
+# IPv6 extension headers and 802.1Q tags are not followed.
+
+# Ethernet header length, and ethertype offset.
+ETHERNET_HEADER_LENGTH = 14
+ETHERNET_TYPE_OFFSET = 12
+
+ETHERTYPES = {"ip": 0x0800, "arp": 0x0806, "ip6": 0x86DD}
+IP_PROTOCOLS = {"icmp": 1, "tcp": 6, "udp": 17, "icmp6": 58}
+
+# Largest TCP/UDP port.
+MAX_PORT = 0xFFFF
+
+COMPILER_DIRECTIONS = {"src", "dst"}
+COMPILER_KINDS = {"host", "net", "port", "portrange"}
+
+
+def _test(loads, jump, k):
+    return ("test", loads, jump, k)
+
+
+def _all(*nodes):
+    node = nodes[0]
+    for other in nodes[1:]:
+        node = ("and", node, other)
+    return node
+
+
+def _any(*nodes):
+    node = nodes[0]
+    for other in nodes[1:]:
+        node = ("or", node, other)
+    return node
+
+
+def _ethertype(name):
+    return _test([(BPF_LD | BPF_H | BPF_ABS, ETHERNET_TYPE_OFFSET)], BPF_JEQ, ETHERTYPES[name])
+
+
+def _ip_protocol(name):
+    """Tests for an IP protocol over IPv4 (not for ICMPv6) or IPv6 (not for ICMP)."""
+    ip4 = _all(_ethertype("ip"), _test([(BPF_LD | BPF_B | BPF_ABS, ETHERNET_HEADER_LENGTH + 9)],
+                                       BPF_JEQ, IP_PROTOCOLS[name]))
+    ip6 = _all(_ethertype("ip6"), _test([(BPF_LD | BPF_B | BPF_ABS, ETHERNET_HEADER_LENGTH + 6)],
+                                        BPF_JEQ, IP_PROTOCOLS[name]))
+    if name == "icmp":
+        return ip4
+    if name == "icmp6":
+        return ip6
+    return _any(ip4, ip6)
+
+
+def _directions(direction):
+    return ("src", "dst") if direction is None else (direction,)
+
+
+def _address_test(address, length, offset):
+    """Tests the address (an ipaddress network) at offset, 32 bits at a time."""
+    packed = address.network_address.packed
+    tests = []
+    for word in range(len(packed) // 4):
+        bits = min(32, max(0, length - word * 32))
+        if bits == 0:
+            break
+        mask = (0xFFFFFFFF << (32 - bits)) & 0xFFFFFFFF
+        value = int.from_bytes(packed[word * 4:word * 4 + 4], "big") & mask
+        loads = [(BPF_LD | BPF_W | BPF_ABS, offset + word * 4)]
+        if mask != 0xFFFFFFFF:
+            loads.append((BPF_ALU | BPF_AND | BPF_K, mask))
+        tests.append(_test(loads, BPF_JEQ, value))
+    return _all(*tests) if tests else _test([(BPF_LD | BPF_IMM, 0)], BPF_JEQ, 0)
+
+
+def _host(protocol, direction, network):
+    """Tests for IPv4 or IPv6 source/destination addresses in a network."""
+    if network.version == 4:
+        if protocol not in (None, "ip"):
+            raise BPFError("host/net with {0} is not supported.".format(protocol))
+        offsets = {"src": ETHERNET_HEADER_LENGTH + 12, "dst": ETHERNET_HEADER_LENGTH + 16}
+        family = _ethertype("ip")
+    else:
+        if protocol not in (None, "ip6"):
+            raise BPFError("host/net with {0} is not supported.".format(protocol))
+        offsets = {"src": ETHERNET_HEADER_LENGTH + 8, "dst": ETHERNET_HEADER_LENGTH + 24}
+        family = _ethertype("ip6")
+    return _all(family, _any(*(_address_test(network, network.prefixlen, offsets[d])
+                               for d in _directions(direction))))
+
+
+def _port(protocol, direction, low, high):
+    """Tests for TCP/UDP source/destination ports between low and high."""
+    if protocol not in (None, "tcp", "udp"):
+        raise BPFError("port with {0} is not supported.".format(protocol))
+    names = ("tcp", "udp") if protocol is None else (protocol,)
+    offsets = {"src": 0, "dst": 2}
+
+    def in_range(loads):
+        if low == high:
+            return _test(loads, BPF_JEQ, low)
+        return _all(_test(loads, BPF_JGE, low), ("not", _test(list(loads), BPF_JGT, high)))
+
+    # IPv4: not a later fragment, ports after the variable length header.
+    ip4 = _all(_ethertype("ip"),
+               _any(*(_test([(BPF_LD | BPF_B | BPF_ABS, ETHERNET_HEADER_LENGTH + 9)], BPF_JEQ, IP_PROTOCOLS[name])
+                      for name in names)),
+               ("not", _test([(BPF_LD | BPF_H | BPF_ABS, ETHERNET_HEADER_LENGTH + 6)], BPF_JSET, 0x1FFF)),
+               _any(*(in_range([(BPF_LDX | BPF_B | BPF_MSH, ETHERNET_HEADER_LENGTH),
+                                (BPF_LD | BPF_H | BPF_IND, ETHERNET_HEADER_LENGTH + offsets[d])])
+                      for d in _directions(direction))))
+    # IPv6: ports after the fixed header.
+    ip6 = _all(_ethertype("ip6"),
+               _any(*(_test([(BPF_LD | BPF_B | BPF_ABS, ETHERNET_HEADER_LENGTH + 6)], BPF_JEQ, IP_PROTOCOLS[name])
+                      for name in names)),
+               _any(*(in_range([(BPF_LD | BPF_H | BPF_ABS, ETHERNET_HEADER_LENGTH + 40 + offsets[d])])
+                      for d in _directions(direction))))
+    return _any(ip4, ip6)
+
+
+def _length(op, value):
+    """Tests the packet length."""
+    loads = [(BPF_LD | BPF_W | BPF_LEN, 0)]
+    tests = {
+        "==": _test(loads, BPF_JEQ, value),
+        "!=": ("not", _test(loads, BPF_JEQ, value)),
+        ">": _test(loads, BPF_JGT, value),
+        ">=": _test(loads, BPF_JGE, value),
+        "<": ("not", _test(loads, BPF_JGE, value)),
+        "<=": ("not", _test(loads, BPF_JGT, value)),
+    }
+    if op not in tests:
+        raise BPFError("Expected a comparison after len.")
+    return tests[op]
+
+
+class FilterParser:
+    """Recursive descent parser for compile_filter, building a tree of tests."""
+    __slots__ = {"tokens", "pos"}
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self):
+        """Returns the next token, or None at the end."""
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def take(self):
+        """Returns the next token and moves past it."""
+        token = self.peek()
+        if token is None:
+            raise BPFError("Unexpected end of filter.")
+        self.pos += 1
+        return token
+
+    def number(self, maximum=0xFFFFFFFF):
+        """Takes a number, from 0 to maximum."""
+        token = self.take()
+        value = common.parse_int(token)
+        if value is None or not 0 <= value <= maximum:
+            raise BPFError("Expected a number up to {0}, found {1}.".format(maximum, token))
+        return value
+
+    def parse_or(self):
+        """Parses a <filter>."""
+        node = self.parse_and()
+        while self.peek() in expression.OR_TOKENS:
+            self.take()
+            node = ("or", node, self.parse_and())
+        return node
+
+    def parse_and(self):
+        """Parses an <and>."""
+        node = self.parse_not()
+        while self.peek() in expression.AND_TOKENS:
+            self.take()
+            node = ("and", node, self.parse_not())
+        return node
+
+    def parse_not(self):
+        """Parses a <not>."""
+        token = self.take()
+        if token in expression.NOT_TOKENS:
+            return ("not", self.parse_not())
+        if token == "(":
+            node = self.parse_or()
+            if self.take() != ")":
+                raise BPFError("Expected ) in filter.")
+            return node
+        return self.parse_primitive(token)
+
+    def parse_primitive(self, token):
+        """Parses a <primitive>, having taken its first token."""
+        if token == "len":
+            op = self.take()
+            return _length(op, self.number())
+        if token == "greater":
+            return _length(">=", self.number())
+        if token == "less":
+            return _length("<=", self.number())
+
+        protocol = None
+        direction = None
+        if token in ETHERTYPES or token in IP_PROTOCOLS:
+            protocol = token
+            if self.peek() not in COMPILER_DIRECTIONS and self.peek() not in COMPILER_KINDS:
+                if protocol in ETHERTYPES:
+                    return _ethertype(protocol)
+                return _ip_protocol(protocol)
+            token = self.take()
+        if token in COMPILER_DIRECTIONS:
+            direction = token
+            token = self.take()
+
+        if token in ("host", "net"):
+            value = self.take()
+            try:
+                network = ipaddress.ip_network(value, strict=False)
+            except ValueError:
+                raise BPFError("Bad {0} {1}.".format(token, value))
+            if token == "host" and network.prefixlen != network.max_prefixlen:
+                raise BPFError("Bad host {0}.".format(value))
+            return _host(protocol, direction, network)
+        if token == "port":
+            port = self.number(MAX_PORT)
+            return _port(protocol, direction, port, port)
+        if token == "portrange":
+            value = self.take()
+            low, _, high = value.partition("-")
+            low = common.parse_int(low)
+            high = common.parse_int(high)
+            if low is None or high is None or not 0 <= low <= high <= MAX_PORT:
+                raise BPFError("Bad portrange {0}.".format(value))
+            return _port(protocol, direction, low, high)
+
+        raise BPFError("Unexpected {0} in filter.".format(token))
+
+
+def compile_filter(text):
+    """
+    Compiles a filter in a small subset of the tcpdump filter language
+    (see above) for Ethernet frames, returning a BPFProgram.
+    """
+    parser = FilterParser(expression.tokenize(text, BPFError, "filter"))
+    tree = parser.parse_or()
+    if parser.peek() is not None:
+        raise BPFError("Unexpected {0} in filter.".format(parser.peek()))
+
+    # Instructions, with jump targets as labels, and label positions.
+    code = []
+    labels = []
+
+    def new_label():
+        labels.append(None)
+        return len(labels) - 1
+
+    def place(label):
+        labels[label] = len(code)
+
+    def emit(node, true, false):
+        kind = node[0]
+        if kind == "test":
+            _, loads, jump, k = node
+            for load_code, load_k in loads:
+                code.append((load_code, None, None, load_k))
+            code.append((BPF_JMP | jump | BPF_K, true, false, k))
+        elif kind == "not":
+            emit(node[1], false, true)
+        else:
+            middle = new_label()
+            if kind == "and":
+                emit(node[1], middle, false)
+            else:
+                emit(node[1], true, middle)
+            place(middle)
+            emit(node[2], true, false)
+
+    accept = new_label()
+    reject = new_label()
+    emit(tree, accept, reject)
+    place(accept)
+    code.append((BPF_RET | BPF_K, None, None, BPF_ACCEPT))
+    place(reject)
+    code.append((BPF_RET | BPF_K, None, None, 0))
+
+    # Resolve labels into jump offsets.
+    program = []
+    for pc, (insn_code, true, false, k) in enumerate(code):
+        jt = 0 if true is None else labels[true] - pc - 1
+        jf = 0 if false is None else labels[false] - pc - 1
+        if jt > BPF_MAXJUMP or jf > BPF_MAXJUMP:
+            raise BPFError("Filter too long, jumps over more than {0} instructions.".format(BPF_MAXJUMP))
+        program.append((insn_code, jt, jf, k))
+    return BPFProgram(program)
+
+
+def prefilter(source, program, linktype=common.LinkType.ETHERNET.value, keep_other=True):
+    """
+    Generator function producing the packets from source that a BPFProgram
+    accepts, run over the raw packet data, so packets need not be
+    identified (and should not be, so rejected packets cost no more).
+    Programs are written for one linktype; packets of other linktypes are
+    produced if keep_other is true, or dropped otherwise.
+    The value a program returns (a snapshot length) is not applied, any
+    nonzero value accepts the whole packet.
+    """
+    run = program.run
+    for packet in source:
+        if packet.linktype != linktype:
+            if keep_other:
+                yield packet
+        elif run(packet.data, packet.origlen):
+            yield packet
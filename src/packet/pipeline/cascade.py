@@ -0,0 +1,109 @@
+"""
+cascade: merges more captures than can be open at once.
+Captures are merged in groups, bounded by a file descriptor budget, into
+temporary intermediate files, which are in turn merged in groups until
+few enough remain to be merged directly.
+The result is the same as merging all the captures in one pass.
+"""
+
+import os
+import tempfile
+
+from ..capfile import pcapng
+from ..capfile.detect import open_reader
+from .merge import merge, source_offsets
+
+# Default number of files open at once, inputs and output.
+CASCADE_FD_BUDGET = 256
+
+# Snapshot length of intermediate files, large enough to not truncate
+# packets from any capture (libpcap's maximum).
+CASCADE_SNAPLEN = 262144
+
+
+def read_start_times(paths):
+    """
+    Returns the time of the first packet of each capture, in integer
+    nanoseconds, or None for empty captures. One file is open at a time.
+    """
+    start_times = []
+    for path in paths:
+        with open(path, "rb") as fstream:
+            packet = next(open_reader(fstream, use_mmap=False).packets(1), None)
+        start_times.append(None if packet is None else packet.timestamp)
+    return start_times
+
+
+def merge_files(paths, offsets, destination):
+    """Merges captures into a writer, adding the given offset to each capture's packets."""
+    streams = [open(path, "rb") for path in paths]
+    try:
+        sources = [open_reader(stream, use_mmap=False).packets() for stream in streams]
+        destination.write_packets(merge(sources, offsets=offsets))
+    finally:
+        for stream in streams:
+            stream.close()
+
+
+def cascade_merge(paths, relative=True, offset=None, fd_budget=CASCADE_FD_BUDGET, tmpdir=None):
+    """
+    Generator function that merges the captures at the given paths,
+    producing the same packets as pipeline.merge.merge would, with at most
+    fd_budget files open at once.
+    relative and offset have the same meaning as for merge; they are
+    computed from the first packet of every capture before merging.
+    Intermediate files are written as nanosecond pcapng files in a temporary
+    directory under tmpdir (Default is the system temporary directory),
+    which is removed once the generator finishes or is closed.
+    """
+    if fd_budget < 3:
+        raise ValueError("fd_budget must be at least 3, got {0}".format(fd_budget))
+
+    # Offsets are computed over all captures, so that every group is shifted
+    # the same way as in a single merge. Empty captures are left out.
+    offsets = source_offsets(read_start_times(paths), relative, offset)
+    sources = [(path, shift) for path, shift in zip(paths, offsets) if shift is not None]
+
+    # One descriptor is kept for the file being written, an intermediate file
+    # or, for the final merge, the caller's output.
+    group_size = fd_budget - 1
+
+    with tempfile.TemporaryDirectory(prefix="pcpapu-merge-", dir=tmpdir) as workdir:
+        level = 0
+        temporary = set()
+        while len(sources) > group_size:
+            intermediates = []
+            for start in range(0, len(sources), group_size):
+                group = sources[start:start + group_size]
+                if len(group) == 1:
+                    # Nothing to merge, carry the capture to the next level.
+                    intermediates.append(group[0])
+                    continue
+
+                path = os.path.join(workdir, "{0}-{1}.pcapng".format(level, len(intermediates)))
+                destination = pcapng.PcapngWriter(open(path, "wb"), tsresol=9, snaplen=CASCADE_SNAPLEN)
+                merge_files([path for path, shift in group], [shift for path, shift in group], destination)
+                destination.close()
+
+                # Intermediate times already have their offsets added.
+                intermediates.append((path, 0))
+                temporary.add(path)
+
+            # Remove the intermediates of the previous level.
+            carried = {path for path, shift in intermediates}
+            for path, shift in sources:
+                if path in temporary and path not in carried:
+                    os.remove(path)
+                    temporary.discard(path)
+
+            sources = intermediates
+            level += 1
+
+        streams = [open(path, "rb") for path, shift in sources]
+        try:
+            # Group order follows source order, so ties break as in a single merge.
+            yield from merge([open_reader(stream, use_mmap=False).packets() for stream in streams],
+                             offsets=[shift for path, shift in sources])
+        finally:
+            for stream in streams:
+                stream.close()
@@ -0,0 +1,167 @@
+"""
+dedup: contains the dedup function, which drops repeated packets.
+Packets are identified by a hash of their bytes, and a packet is dropped if
+the same bytes were seen within a time window. The table of recent hashes
+is bounded in time and size, so memory use is flat on endless streams.
+"""
+
+import hashlib
+from collections import OrderedDict
+
+from .. import common
+from ..identity import eth
+
+# Default time a packet is remembered for, in nanoseconds (100 ms).
+DEDUP_WINDOW = 10**8
+
+# Default maximum number of packets remembered at once.
+DEDUP_MAX_ENTRIES = 2**20
+
+# Fields that can be left out of the comparison, as they may differ
+# between copies of a frame taken at different points of a network.
+DEDUP_IGNORE_MAC = "mac"
+DEDUP_IGNORE_TTL = "ttl"
+DEDUP_IGNORE_CHECKSUM = "checksum"
+DEDUP_IGNORE_FIELDS = {DEDUP_IGNORE_MAC, DEDUP_IGNORE_TTL, DEDUP_IGNORE_CHECKSUM}
+
+# IP versions, by ethertype. Other ethertypes are not masked.
+DEDUP_ETHERTYPE_VERSIONS = {
+    eth.ETHERTYPE_IP4: 4,
+    eth.ETHERTYPE_IP6: 6
+}
+
+# IP protocol numbers, and the offset of their checksum field.
+DEDUP_CHECKSUM_OFFSETS = {
+    6: 16,  # TCP
+    17: 6   # UDP
+}
+
+
+class DedupStats:
+    """
+    Counters kept by dedup.
+     - packets: Packets read.
+     - duplicates: Packets dropped as duplicates.
+     - evicted: Packets forgotten before their window ended, as the table
+       was full. If this is not zero, some duplicates may have been missed.
+    """
+    __slots__ = {"packets", "duplicates", "evicted"}
+
+    def __init__(self):
+        self.packets = 0
+        self.duplicates = 0
+        self.evicted = 0
+
+    def __str__(self):
+        return "Packets: {0}, Duplicates: {1}, Evicted: {2}".format(
+            self.packets, self.duplicates, self.evicted)
+
+
+def mask_fields(data, linktype, ignore):
+    """
+    Returns a copy of a packet's data with the fields named in ignore zeroed.
+    Fields are found at fixed offsets in Ethernet (with 802.1Q/1AD tags),
+    and raw IPv4/IPv6 frames; other linktypes, and Ethernet frames with
+    other ethertypes, are copied unchanged, apart from MAC addresses.
+    IPv6 extension headers are not followed.
+    """
+    buf = bytearray(data)
+
+    if linktype == common.LinkType.ETHERNET.value:
+        if len(buf) < 14:
+            return buf
+        if DEDUP_IGNORE_MAC in ignore:
+            buf[0:12] = bytes(12)
+        offset = eth.find_ethertype_offset(buf) + 2
+        if len(buf) < offset:
+            return buf
+        # Only the ethertype tells IP from other payloads.
+        version = DEDUP_ETHERTYPE_VERSIONS.get(eth.ETHERTYPE_FIELD.unpack_from(buf, offset - 2)[0])
+        if version is None or len(buf) < offset + 1 or buf[offset] >> 4 != version:
+            return buf
+    elif linktype in (common.LinkType.RAW.value, common.LinkType.IPV4.value, common.LinkType.IPV6.value):
+        offset = 0
+        if len(buf) < offset + 1:
+            return buf
+        version = buf[offset] >> 4
+    else:
+        return buf
+
+    if version == 4 and len(buf) >= offset + 20:
+        if DEDUP_IGNORE_TTL in ignore:
+            buf[offset + 8] = 0
+        if DEDUP_IGNORE_CHECKSUM in ignore:
+            buf[offset + 10:offset + 12] = bytes(2)
+        # Only the first fragment holds the transport header.
+        if (buf[offset + 6] & 0x1F) != 0 or buf[offset + 7] != 0:
+            return buf
+        protocol = buf[offset + 9]
+        offset += (buf[offset] & 0x0F) * 4
+    elif version == 6 and len(buf) >= offset + 40:
+        if DEDUP_IGNORE_TTL in ignore:
+            buf[offset + 7] = 0
+        protocol = buf[offset + 6]
+        offset += 40
+    else:
+        return buf
+
+    checksum_offset = DEDUP_CHECKSUM_OFFSETS.get(protocol)
+    if DEDUP_IGNORE_CHECKSUM in ignore and checksum_offset is not None and \
+      len(buf) >= offset + checksum_offset + 2:
+        buf[offset + checksum_offset:offset + checksum_offset + 2] = bytes(2)
+
+    return buf
+
+
+def packet_digest(packet, ignore=frozenset()):
+    """Returns a digest of a packet's linktype and data, leaving out the fields in ignore."""
+    digest = hashlib.md5(packet.linktype.to_bytes(4, "little"))
+    if ignore:
+        digest.update(mask_fields(packet.data, packet.linktype, ignore))
+    else:
+        digest.update(packet.data)
+    return digest.digest()
+
+
+def dedup(source, window=DEDUP_WINDOW, max_entries=DEDUP_MAX_ENTRIES, ignore=frozenset(), stats=None):
+    """
+    Generator function that produces the packets from source, leaving out
+    any packet whose bytes match a packet produced up to 'window' nanoseconds
+    before it.
+    At most max_entries packets are remembered; beyond that the oldest are
+    forgotten early. ignore is a set of fields (DEDUP_IGNORE_FIELDS)
+    to leave out of the comparison.
+    If stats is a DedupStats object, it is updated as packets are read.
+    The source should be in time order, as merge produces.
+    """
+    unknown = set(ignore) - DEDUP_IGNORE_FIELDS
+    if unknown:
+        raise ValueError("Unknown fields {0}".format(", ".join(sorted(unknown))))
+    if stats is None:
+        stats = DedupStats()
+
+    # Maps a digest to the time it was first seen, oldest first.
+    seen = OrderedDict()
+
+    for packet in source:
+        timestamp = packet.timestamp
+        stats.packets += 1
+
+        # Forget packets whose window has ended.
+        while seen:
+            digest, first = next(iter(seen.items()))
+            if timestamp - first <= window:
+                break
+            del seen[digest]
+
+        digest = packet_digest(packet, ignore)
+        if digest in seen:
+            stats.duplicates += 1
+            continue
+
+        seen[digest] = timestamp
+        if len(seen) > max_entries:
+            seen.popitem(last=False)
+            stats.evicted += 1
+
+        yield packet
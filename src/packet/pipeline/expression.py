@@ -0,0 +1,335 @@
+"""
+expression: a filter expression language, compiled to closures.
+An expression is parsed once, into a tree of small functions each taking a
+packet and doing one test, which select then calls for every packet.
+
+Expressions have the form:
+<expr> ::= <and> | <and> "or" <expr>
+<and> ::= <not> | <not> "and" <and>
+<not> ::= <test> | "not" <not> | "(" <expr> ")"
+<test> ::= <ref> | <ref> <op> <value>
+<ref> ::= <protocol name> | <protocol name> "." <field> | "len" | "caplen"
+<op> ::= "==" | "!=" | "<" | "<=" | ">" | ">=" | "in"
+"&&", "||" and "!" may be used for "and", "or" and "not".
+
+A protocol name alone is true for packets with that protocol in their
+identity. A field alone is true if the protocol has the field. Fields are
+those of the protocol's get_header (see Protocol.header_fields), or failing
+that, its attributes (see Protocol.attribute_fields); other names are
+rejected. "len" and "caplen" are the original and captured length of the
+packet.
+
+Values are parsed as the protocol's build_attributes would parse an
+attribute of the same name (so addresses and prefixes work, see
+ip.build_address_attribute), or as integers. "in" (or "==") also accepts
+an inclusive range, "<low>..<high>". Comparisons are false for packets
+without the field. For example:
+    tcp.dport in 8000..8080 or (udp and not udp.dport == 53)
+    ip4.saddr in 10.0.0.0/8 and len > 1000
+"""
+
+import re
+import struct
+import operator
+
+from .. import common
+from ..identity import core as identity_core
+
+
+class ExpressionError(ValueError):
+    """Exception raised for a malformed filter expression."""
+    pass
+
+
+# Operators and parentheses, or words (names, fields and values).
+TOKEN_PATTERN = re.compile(r"\s*(?:(\(|\)|==|!=|<=|>=|<|>|&&|\|\||!)|([^\s()!<>=&|]+))")
+
+COMPARISONS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+# Comparisons needing integers on both sides.
+ORDERINGS = {"<", "<=", ">", ">="}
+
+AND_TOKENS = {"and", "&&"}
+OR_TOKENS = {"or", "||"}
+NOT_TOKENS = {"not", "!"}
+KEYWORDS = AND_TOKENS | OR_TOKENS | NOT_TOKENS | {"in"}
+
+# Fields of the packet itself.
+PACKET_FIELDS = {
+    "len": lambda packet: packet.origlen,
+    "caplen": lambda packet: len(packet.data),
+}
+
+# Value of a field a packet doesn't have.
+MISSING = object()
+
+
+def tokenize(text, error=ExpressionError, kind="expression"):
+    """
+    Splits an expression into a list of tokens. Unexpected characters raise
+    'error', with a message naming the text as 'kind'.
+    """
+    tokens = []
+    text = text.rstrip()
+    pos = 0
+    while pos < len(text):
+        match = TOKEN_PATTERN.match(text, pos)
+        if match is None:
+            raise error("Unexpected character in {0}: {1}".format(kind, text[pos:].strip()))
+        tokens.append(match.group(1) or match.group(2))
+        pos = match.end()
+    return tokens
+
+
+def compile_expression(text):
+    """
+    Compiles an expression, returning a function taking an identified
+    packet and returning True if it matches.
+    Raises ExpressionError if the expression is malformed.
+    """
+    parser = ExpressionParser(tokenize(text))
+    predicate = parser.parse_or()
+    if parser.peek() is not None:
+        raise ExpressionError("Unexpected {0} in expression.".format(parser.peek()))
+    return predicate
+
+
+class ExpressionParser:
+    """Recursive descent parser, building the closures as it goes."""
+    __slots__ = {"tokens", "pos"}
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self):
+        """Returns the next token, or None at the end."""
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def take(self):
+        """Returns the next token and moves past it."""
+        token = self.peek()
+        if token is None:
+            raise ExpressionError("Unexpected end of expression.")
+        self.pos += 1
+        return token
+
+    def parse_or(self):
+        """Parses an <expr>."""
+        predicate = self.parse_and()
+        while self.peek() in OR_TOKENS:
+            self.take()
+            predicate = either(predicate, self.parse_and())
+        return predicate
+
+    def parse_and(self):
+        """Parses an <and>."""
+        predicate = self.parse_not()
+        while self.peek() in AND_TOKENS:
+            self.take()
+            predicate = both(predicate, self.parse_not())
+        return predicate
+
+    def parse_not(self):
+        """Parses a <not>."""
+        token = self.take()
+        if token in NOT_TOKENS:
+            return negate(self.parse_not())
+        if token == "(":
+            predicate = self.parse_or()
+            if self.take() != ")":
+                raise ExpressionError("Expected ) in expression.")
+            return predicate
+        if token == ")" or token in KEYWORDS or token in COMPARISONS:
+            raise ExpressionError("Unexpected {0} in expression.".format(token))
+        return self.parse_test(token)
+
+    def parse_test(self, ref):
+        """Parses a <test>, having taken its reference."""
+        protocol, field, value = compile_reference(ref)
+
+        op = self.peek()
+        if op not in COMPARISONS and op != "in":
+            # Existence test.
+            if field is None and protocol is not None:
+                find = compile_finder(protocol)
+                return lambda packet: find(packet) is not None
+            return lambda packet: value(packet) is not MISSING
+
+        self.take()
+        if field is None and protocol is not None:
+            raise ExpressionError("{0} is a protocol, not a field.".format(ref))
+        return compile_comparison(ref, protocol, field, value, op, self.take())
+
+
+def either(a, b):
+    """Returns a function true if either of two functions is."""
+    return lambda packet: a(packet) or b(packet)
+
+
+def both(a, b):
+    """Returns a function true if both of two functions are."""
+    return lambda packet: a(packet) and b(packet)
+
+
+def negate(a):
+    """Returns a function true if a function is not."""
+    return lambda packet: not a(packet)
+
+
+def compile_finder(protocol):
+    """Returns a function finding the instance of a protocol class in a packet's identity."""
+    def find(packet):
+        layer = packet.identity
+        while layer is not None:
+            if type(layer) is protocol:
+                return layer
+            layer = layer.next
+        return None
+    return find
+
+
+def compile_reference(ref):
+    """
+    Resolves a field reference, returning a (protocol class, field name,
+    value function) tuple. The value function returns the field of a packet,
+    or MISSING. Protocol and field are None for packet fields.
+    """
+    if ref in PACKET_FIELDS:
+        return None, None, PACKET_FIELDS[ref]
+
+    protoname, _, field = ref.partition(".")
+    if protoname not in identity_core.protocol_registry:
+        raise ExpressionError("Unknown protocol {0}.".format(protoname))
+    protocol = identity_core.protocol_registry[protoname]
+    find = compile_finder(protocol)
+
+    if not field:
+        return protocol, None, None
+
+    if field not in protocol.header_fields and field not in protocol.attribute_fields:
+        raise ExpressionError("Unknown field {0} of {1}.".format(field, protoname))
+
+    def attribute(layer):
+        try:
+            return layer.get_cached_attributes().get(field, MISSING)
+        except (struct.error, IndexError):
+            # Truncated header.
+            return MISSING
+
+    if field in protocol.header_fields:
+        index = protocol.header_fields.index(field)
+
+        def value(packet):
+            layer = find(packet)
+            if layer is None:
+                return MISSING
+            try:
+                return layer.get_header()[index]
+            except struct.error:
+                # Truncated header, the field may still be an attribute.
+                return attribute(layer)
+    else:
+        def value(packet):
+            layer = find(packet)
+            if layer is None:
+                return MISSING
+            return attribute(layer)
+
+    return protocol, field, value
+
+
+def parse_value(ref, protocol, field, valuestr):
+    """Parses a value to compare a field with."""
+    literal = None
+    if protocol is not None:
+        try:
+            literal = protocol.build_attributes("{0}={1}".format(field, valuestr)).get(field)
+        except OSError as error:
+            raise ExpressionError("Can't read value for {0}: {1}".format(ref, error))
+        except ValueError as error:
+            raise ExpressionError("Bad value {0} for {1}: {2}".format(valuestr, ref, error))
+    if literal is None:
+        literal = common.parse_int(valuestr)
+    if literal is None:
+        raise ExpressionError("Bad value {0} for {1}.".format(valuestr, ref))
+    return literal
+
+
+def compile_comparison(ref, protocol, field, value, op, valuestr):
+    """Returns a function comparing a field of a packet with a value."""
+    if valuestr in KEYWORDS or valuestr in COMPARISONS or valuestr in ("(", ")"):
+        raise ExpressionError("Expected a value after {0} {1}.".format(ref, op))
+
+    if (op in ORDERINGS or ".." in valuestr) and protocol is not None and field in protocol.unordered_fields:
+        raise ExpressionError("{0} is not a number, it can only be compared with ==, != and in.".format(ref))
+
+    if ".." in valuestr:
+        if op not in ("in", "==", "!="):
+            raise ExpressionError("Ranges can only be used with in, == and !=.")
+        low, _, high = valuestr.partition("..")
+        low = common.parse_int(low)
+        high = common.parse_int(high)
+        if low is None or high is None:
+            raise ExpressionError("Bad range {0} for {1}.".format(valuestr, ref))
+
+        inside = op != "!="
+
+        def in_range(packet):
+            v = value(packet)
+            try:
+                return v is not MISSING and (low <= v <= high) == inside
+            except TypeError:
+                return False
+        return in_range
+
+    literal = parse_value(ref, protocol, field, valuestr)
+
+    if isinstance(literal, identity_core.AttributeMatcher):
+        if op not in ("in", "==", "!="):
+            raise ExpressionError("Sets of values can only be used with in, == and !=.")
+        matches = literal.matches
+        inside = op != "!="
+
+        def in_set(packet):
+            v = value(packet)
+            return v is not MISSING and matches(v) == inside
+        return in_set
+
+    if op in ORDERINGS and type(literal) is not int:
+        raise ExpressionError("{0} {1} needs a number, not {2}.".format(ref, op, valuestr))
+
+    if op in ("in", "=="):
+        # MISSING equals nothing.
+        return lambda packet: value(packet) == literal
+
+    compare = COMPARISONS[op]
+
+    def comparison(packet):
+        v = value(packet)
+        try:
+            return v is not MISSING and compare(v, literal)
+        except TypeError:
+            return False
+    return comparison
+
+
+def select(source, expression):
+    """
+    Generator function producing the packets from source matching an
+    expression, given as a string or as compiled by compile_expression.
+    Packets must be identified first.
+    """
+    if isinstance(expression, str):
+        expression = compile_expression(expression)
+
+    for packet in source:
+        if expression(packet):
+            yield packet
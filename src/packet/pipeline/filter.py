@@ -1,7 +1,9 @@
 """
-filter: contains the filter function.
+filter: contains the filter function, and the rule set compiler it uses.
 """
 
+from ..identity import core as identity_core
+
 KEEP = True
 DISCARD = False
 
@@ -12,24 +14,185 @@ def identity_match(protocol_instances, prototypes):
     'prototypes'.
     Every prototype must match it's corresponding protocol instance.
     Prototypes are a (name, attrs) tuple.
+    Protocol instances past the last prototype are not looked at, so they
+    are not interpreted if dissection was depth limited.
     """
-    prototype_iter = iter(prototypes)
-    match = False
-    for protocol_instance, prototype in zip(protocol_instances, prototype_iter):
-        if protocol_instance.name is not prototype[0] or \
-          not protocol_instance.match_attributes(prototype[1]):
-            break
-    else:
+    protocol_instance = None
+    for prototype in prototypes:
+        protocol_instance = protocol_instances if protocol_instance is None \
+            else protocol_instance.next
         # A short prototype list should match a more specific protocol identity,
         # but a short identity should not match a more specific prototype list.
-        # This sees if the number of prototypes exceeds
-        # the number of protocol_instances.
+        if protocol_instance is None or \
+          protocol_instance.name != prototype[0] or \
+          not protocol_instance.match_attributes(prototype[1]):
+            return False
+
+    return True
+
+
+def required_depth(*identity_sets):
+    """
+    Returns the number of protocols that must be interpreted to match
+    packets against the given sets of identities, for identify's depth.
+    """
+    return max((len(prototypes) for identities in identity_sets if identities
+                for prototypes in identities), default=0)
+
+
+class RuleNode:
+    """
+    Node of a compiled rule set, standing for the protocol instances at one
+    depth of an identity, after a path of protocol names and attributes.
+     - terminal: True if an identity ends here, so everything reaching
+       this node matches.
+     - branches: Dict of protocol name -> RuleBranch, for the next protocol.
+    """
+    __slots__ = {"terminal", "branches"}
+
+    def __init__(self):
+        self.terminal = False
+        self.branches = {}
+
+
+class RuleBranch:
+    """
+    The prototypes for one protocol name at a RuleNode, each leading to
+    another RuleNode. Prototypes are kept in one of three ways,
+     - unconditional: The node for prototypes without attributes.
+     - indexes: Dict of attribute key -> dict of value -> list of
+       (remaining attributes, node) tuples. Prototypes testing a key for
+       an exact value are found with a single lookup of the instance's value.
+     - scan: List of (attributes, node) tuples, tested one at a time with
+       match_attributes. Used for prototypes with only wildcards,
+       AttributeMatchers or unhashable values, and protocols with their own
+       match_attributes.
+    Prototypes with the same attributes share a node.
+    """
+    __slots__ = {"unconditional", "indexes", "scan", "nodes", "indexed"}
+
+    def __init__(self, indexed):
+        self.unconditional = None
+        self.indexes = {}
+        self.scan = []
+        # Nodes, by attributes, so equal prototypes share them.
+        self.nodes = {}
+        # False if the protocol matches attributes its own way.
+        self.indexed = indexed
+
+    def add(self, attrs):
+        """Returns the node for a prototype's attributes, adding it if new."""
         try:
-            next(prototype_iter)
-        except StopIteration:
-            match = True
+            ident = frozenset(attrs.items())
+            node = self.nodes.get(ident)
+        except TypeError:
+            # Unhashable values, not shared.
+            ident = None
+            node = None
+        if node is not None:
+            return node
+
+        node = RuleNode()
+        if ident is not None:
+            self.nodes[ident] = node
+
+        # Key to index the prototype by, preferring keys already indexed.
+        exact = sorted((key for key, value in attrs.items()
+                        if value is not identity_core.ATTRIBUTE_WILDCARD and
+                        not isinstance(value, identity_core.AttributeMatcher)),
+                       key=lambda key: (key not in self.indexes, key))
+        if not self.indexed or ident is None or (attrs and not exact):
+            self.scan.append((attrs, node))
+        elif not attrs:
+            self.unconditional = node
+        else:
+            key = exact[0]
+            rest = {k: v for k, v in attrs.items() if k != key}
+            self.indexes.setdefault(key, {}).setdefault(attrs[key], []).append((rest, node))
+        return node
+
+    def candidates(self, instance):
+        """Generates the nodes of the prototypes matching a protocol instance."""
+        if self.unconditional is not None:
+            yield self.unconditional
+
+        if self.indexes:
+            sattrs = instance.get_cached_attributes()
+            for key, index in self.indexes.items():
+                if key not in sattrs:
+                    continue
+                try:
+                    entries = index.get(sattrs[key])
+                except TypeError:
+                    # Unhashable attribute value, can't equal a hashable one.
+                    continue
+                if entries is not None:
+                    for rest, node in entries:
+                        if not rest or instance.match_attributes(rest):
+                            yield node
+
+        for attrs, node in self.scan:
+            if instance.match_attributes(attrs):
+                yield node
+
+
+class RuleSet:
+    """
+    A set of identities compiled into a trie of protocol names, with
+    attribute indexes at each level (see RuleBranch).
+    match gives the same result as testing each identity with identity_match,
+    but with thousands of identities, a packet only visits those sharing
+    its protocols and attribute values.
+    """
+    __slots__ = {"root", "size"}
+
+    def __init__(self, identities=()):
+        self.root = RuleNode()
+        self.size = 0
+        for prototypes in identities:
+            self.add(prototypes)
+
+    def __len__(self):
+        """Returns the number of identities added."""
+        return self.size
+
+    def add(self, prototypes):
+        """Adds an identity (a list of prototypes) to the set."""
+        node = self.root
+        for name, attrs in prototypes:
+            branch = node.branches.get(name)
+            if branch is None:
+                protocol = identity_core.lookup_protocol(name)
+                indexed = protocol.match_attributes is identity_core.Protocol.match_attributes
+                branch = node.branches[name] = RuleBranch(indexed)
+            node = branch.add(attrs)
+        node.terminal = True
+        self.size += 1
+
+    def match(self, protocol_instances):
+        """Returns True if a packet's identity matches any identity in the set."""
+        if self.root.terminal:
+            return True
+        if protocol_instances is None:
+            return False
+        return _match_node(self.root, protocol_instances)
+
+
+def _match_node(node, instance):
+    """Returns True if the protocol instance (and children) reach a terminal node below node."""
+    branch = node.branches.get(instance.name)
+    if branch is None:
+        return False
 
-    return match
+    for child in branch.candidates(instance):
+        if child.terminal:
+            return True
+        # As with identity_match, children are only read when needed.
+        if child.branches:
+            child_instance = instance.next
+            if child_instance is not None and _match_node(child, child_instance):
+                return True
+    return False
 
 
 # Any identity matching something in the keep set is kept.
@@ -45,22 +208,20 @@ def filter(source, keep=None, discard=None, policy=KEEP):
     The name must match that of the corresponding protocol instance, and the
     match_attributes method of the corresponding protocol instance must
     return true when presented with the prototype attributes.
+    The sets are compiled into RuleSets first, unless they already are.
     """
-    if keep is None:
-        keep = set()
-    if discard is None:
-        discard = set()
+    if not isinstance(keep, RuleSet):
+        keep = RuleSet(keep or ())
+    if not isinstance(discard, RuleSet):
+        discard = RuleSet(discard or ())
 
     for packet in source:
-        yield_packet = policy
-        for prototypes in keep:
-            if identity_match(packet.identity, prototypes):
-                yield_packet = True
-                break
+        identity = packet.identity
+        if keep.match(identity):
+            yield_packet = True
+        elif discard.match(identity):
+            yield_packet = False
         else:
-            for prototypes in discard:
-                if identity_match(packet.identity, prototypes):
-                    yield_packet = False
-                    break
+            yield_packet = policy
         if yield_packet:
             yield packet
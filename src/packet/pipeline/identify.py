@@ -2,34 +2,118 @@
 identify: Contains the identify function.
 """
 
+from collections import deque, OrderedDict
+
 from .. identity import core as identity_core
 
+# Default maximum number of packets held back waiting for their identity.
+IDENTIFY_MAX_BUFFER = 2**16
+
+# Default maximum time a packet is held back for, in nanoseconds of packet
+# time (30 seconds, as common IP reassembly timeouts).
+IDENTIFY_MAX_HOLD = 30 * 10**9
 
-def identify(source):
+
+def identify(source, max_buffer=IDENTIFY_MAX_BUFFER, max_hold=IDENTIFY_MAX_HOLD, ordered=True, depth=None,
+             compact=False):
     """
     Returns each packet in the source, with the packet identity set.
-    This generator will defer packets until their identity is complete.
-    As a result, this generator can consume a lot of memory, up to the total
-    number of packets produced by source.
+    This generator will defer packets until their identity is complete,
+    so that (for instance) every fragment of an IP datagram is produced
+    with the reassembled payload identified.
 
+    A deferred packet is released with an incomplete identity once more than
+    max_buffer packets are held, or once a packet more than max_hold
+    nanoseconds newer is read. Either bound may be None for no limit.
     If the source is exhausted before a packet's identity is complete,
     the packets will then be returned regardless of status.
+
+    If ordered is true, packets are produced in the order they were read,
+    so packets behind a deferred packet are held too.
+    Otherwise, complete packets are produced immediately and deferred packets
+    once they complete; every packet has its 'sequence' field set to its
+    position in the source, so the original order can be recovered.
+
+    If depth is not None, only the first 'depth' protocols of each packet
+    are interpreted up front (see filter.required_depth), the rest when first
+    accessed. Completeness only covers the interpreted protocols.
+
+    If compact is true, complete packets held behind a deferred packet keep
+    their identity in compact form (see Packet.compact) while they wait.
     """
-    # Deferred packets go here.
-    buf = []
+    if ordered:
+        yield from _identify_ordered(source, max_buffer, max_hold, depth, compact)
+    else:
+        yield from _identify_unordered(source, max_buffer, max_hold, depth)
+
+
+def _must_release(held, oldest, packet, max_buffer, max_hold):
+    """
+    Returns True if the oldest of 'held' packets must be released, when
+    packet is read.
+    """
+    return (max_buffer is not None and held > max_buffer) or \
+        (max_hold is not None and packet.timestamp - oldest.timestamp > max_hold)
+
+
+def _identify_ordered(source, max_buffer, max_hold, depth, compact):
+    """identify, producing packets in source order."""
+    # Deferred packets, and packets behind them, go here.
+    buf = deque()
 
     for packet in source:
         # Identify:
-        identity_core.root_identify(packet)
-        if not packet.identity.is_complete():
-            buf.append(packet)
+        identity_core.root_identify(packet, depth)
+        if not buf and packet.identity.is_complete():
+            yield packet
             continue
 
-        if len(buf) > 0:
-            while len(buf) > 0 and buf[0].identity.is_complete():
-                yield buf.pop(0)
-        else:
+        if compact and buf:
+            # Only complete identities are compacted, so compacted packets
+            # are released without expanding them.
+            packet.compact()
+        buf.append(packet)
+        while buf and (buf[0].compacted or buf[0].identity.is_complete() or
+                       _must_release(len(buf), buf[0], packet, max_buffer, max_hold)):
+            yield buf.popleft()
+
+    yield from buf
+
+
+def _identify_unordered(source, max_buffer, max_hold, depth):
+    """identify, producing complete packets first."""
+    # Deferred packets, in source order, by the id of their root protocol
+    # instance, so packets can be found from the instances completed.
+    buf = OrderedDict()
+    completed_instances = identity_core.completed_instances
+    sequence = 0
+
+    for packet in source:
+        packet.sequence = sequence
+        sequence += 1
+
+        # Identify:
+        identity_core.root_identify(packet, depth)
+
+        # The packet may have completed deferred packets (e.g. as the last
+        # fragment of a datagram), release those first.
+        if buf and completed_instances:
+            completed = []
+            for instance in completed_instances:
+                while instance.prev is not None:
+                    instance = instance.prev
+                deferred = buf.get(id(instance))
+                if deferred is not None and deferred.identity.is_complete():
+                    completed.append(buf.pop(id(instance)))
+            completed.sort(key=lambda deferred: deferred.sequence)
+            yield from completed
+
+        if packet.identity.is_complete():
             yield packet
+        else:
+            buf[id(packet.identity)] = packet
+
+        while buf and _must_release(len(buf), next(iter(buf.values())), packet, max_buffer, max_hold):
+            yield buf.popitem(last=False)[1]
 
-    for leftover in buf:
-        yield leftover
+    yield from buf.values()
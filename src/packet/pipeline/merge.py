@@ -2,69 +2,87 @@
 merge: contains the definition for the merge function.
 """
 
-from .. import common
+import heapq
 
 
-def merge(preaders, relative=True, offset=None):
+def source_offsets(start_times, relative=True, offset=None):
+    """
+    Computes the offset merge adds to the times of each source's packets.
+    start_times holds the time of the first packet of each source, in integer
+    nanoseconds, or None for an empty source (which is given a None offset).
+    relative and offset have the same meaning as for merge.
+    """
+    times = [st for st in start_times if st is not None]
+    if not times:
+        return [None] * len(start_times)
+
+    # If no specific time offset is used, use the average start time.
+    if offset is None:
+        offset = sum(times) // len(times)
+
+    return [None if st is None else (-st if relative else 0) + offset
+            for st in start_times]
+
+
+def merge(preaders, relative=True, offset=None, offsets=None):
     """
     Generator function that takes a list of packet sources and two parameters.
     If relative is true, then the time of the -first- packet from a source is
     subtracted from all packets from that source.
-    If offset is not none, this value is added to the time of all packets,
-    otherwise the average start time is used.
+    If offset is not none, this value (in integer nanoseconds) is added to the
+    time of all packets, otherwise the average start time is used.
     Returns a generator that produces the next chronological packet on each iteration.
+    Packets with equal times are produced in the order of their sources.
+    If offsets is not None, it is a list holding the offset to add to each
+    source's packets, as returned by source_offsets, used instead of relative
+    and offset. This allows sources to be merged in several passes.
     """
-    # Create a local copy of the 'preaders' argument
-    # we don't want to modify the original.
-    tails = preaders[:]
-    heads = []
+    # Heap of (time, source index, packet) entries, one per non-empty source.
+    # The source index breaks ties, so packets themselves are never compared.
+    heap = []
+    tails = list(preaders)
+    start_times = [None] * len(tails)
 
-    # Create a list of 'heads',
-    # packets in the start of each source, deleting empty sources.
-    src_count = len(tails)
-    i = 0
-    while i < src_count:
+    # Read the 'heads', packets in the start of each source,
+    # skipping empty sources.
+    for idx, preader in enumerate(tails):
         try:
-            heads.append(next(tails[i]))
-            i += 1
+            packet = next(preader)
         except StopIteration:
-            del tails[i]
-            src_count -= 1
+            tails[idx] = None
+            continue
+        heap.append((packet.timestamp, idx, packet))
+        start_times[idx] = packet.timestamp
 
-    # Create list of staring packet times.
-    times = [pkt.unixtime for pkt in heads]
+    if not heap:
+        return
 
-    # If no specific time offset is used, use the average start time.
-    if offset is None:
-        offset = sum(times) / len(times)
+    # Create a list of computed offsets, unless they were given.
+    if offsets is None:
+        offsets = source_offsets(start_times, relative, offset)
 
-    # Create a list of computed offsets.
-    offsets = [(-st if relative else 0) + offset for st in times]
+    # Add the offsets to the initial packets.
+    heap = [(timestamp + offsets[idx], idx, packet) for timestamp, idx, packet in heap]
+    for timestamp, idx, packet in heap:
+        packet.timestamp = timestamp
 
-    # Add all the computed offsets to the initial packets.
-    for i in range(0, src_count):
-        heads[i].unixtime += offsets[i]
+    heapq.heapify(heap)
 
     # While there are packet sources left...
-    while src_count > 0:
-        min_p = common.PACKET_MAXAGE
-        # Find the index of the oldest packet.
-        for j in range(0, src_count):
-            if heads[j] <= min_p:
-                min_p = heads[j]
-                min_idx = j
+    while heap:
+        # The oldest packet is at the top of the heap.
+        idx = heap[0][1]
 
-        # Yield, returning the next chronoligcal packet.
-        yield heads[min_idx]
+        # Yield, returning the next chronological packet.
+        yield heap[0][2]
 
         try:
-            # Get the next packet from the source this packet came from.
-            heads[min_idx] = next(tails[min_idx])
-            # Calculate new time for the packet.
-            heads[min_idx].unixtime += offsets[min_idx]
+            # Get the next packet from the source this packet came from,
+            # and replace the top of the heap with it.
+            packet = next(tails[idx])
+            packet.timestamp += offsets[idx]
+            heapq.heapreplace(heap, (packet.timestamp, idx, packet))
         except StopIteration:
             # This indicates there are no more packets in this source.
-            del heads[min_idx]
-            del tails[min_idx]
-            del offsets[min_idx]
-            src_count -= 1
+            heapq.heappop(heap)
+            tails[idx] = None
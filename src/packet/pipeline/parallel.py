@@ -0,0 +1,99 @@
+"""
+parallel: runs a pipeline stage over a single pcap file in several processes.
+The file is split into byte ranges, each worker finds the first record
+boundary in its range, identifies and processes the records starting in it,
+and the results are put back together in the original order.
+"""
+
+import os
+import array
+import multiprocessing
+
+from ..capfile import pcap
+from .identify import identify
+from . import bpf
+
+# Smallest byte range given to a worker.
+PARALLEL_MIN_CHUNK_SIZE = 2**20
+
+# Number of byte ranges per worker process, to balance uneven ranges.
+PARALLEL_CHUNKS_PER_JOB = 4
+
+
+def scan_chunk(path, start, end, stage, stage_args, depth=None, prefilter=None):
+    """
+    Worker function. Identifies the records of a pcap file starting in the byte
+    range [start, end), after resynchronising both ends on record boundaries,
+    and passes them through stage(packets, *stage_args).
+    The stage must yield (a subset of) the packets it is given, and leave
+    their sequence field, which holds the record's file offset.
+    depth limits dissection, as for identify.
+    prefilter is an optional bpf.BPFProgram, packets it rejects are dropped
+    before identification.
+    Returns the file offsets of the records the stage yielded, in order.
+    """
+    reader = pcap.PcapMmapReader(open(path, "rb"))
+    first = reader.resync(start)
+    last = reader.resync(end)
+
+    def packets():
+        reader.seek(first)
+        while reader.tell() < last:
+            offset = reader.tell()
+            packet = reader.read_packet()
+            if packet is None:
+                return
+            # Packets carry their record offset, so nothing is kept for
+            # the records dropped along the way.
+            packet.sequence = offset
+            yield packet
+
+    source = packets()
+    if prefilter is not None:
+        source = bpf.prefilter(source, prefilter)
+    result = array.array("Q", (packet.sequence
+                               for packet in stage(identify(source, depth=depth), *stage_args)))
+    reader.close()
+    return result
+
+
+def _scan_chunk_args(args):
+    """Unpacks an argument tuple for scan_chunk, for Pool.imap."""
+    return scan_chunk(*args)
+
+
+def split_file(path, count):
+    """Splits a file into (at most) count byte ranges, returning (start, end) tuples."""
+    size = os.path.getsize(path)
+    chunk_size = max(PARALLEL_MIN_CHUNK_SIZE, -(-size // max(1, count)))
+    return [(start, min(size, start + chunk_size)) for start in range(0, size, chunk_size)]
+
+
+def parallel_stage(path, stage, stage_args=(), jobs=None, depth=None, prefilter=None):
+    """
+    Generator function that runs a pipeline stage over a pcap file in 'jobs'
+    worker processes (Default is the number of CPUs), yielding the packets
+    it keeps in the original order.
+    'stage' is a generator function such as pipeline.filter.filter, taking
+    identified packets and yielding those to keep. It, and stage_args, must be
+    picklable. Packets are yielded unidentified, as read from the file.
+    Protocol state (IP fragments, TCP) is not shared between workers, so
+    packets depending on state from another range are seen incomplete.
+    depth limits dissection, and prefilter drops packets before it,
+    as for scan_chunk.
+    """
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+
+    reader = pcap.PcapMmapReader(open(path, "rb"))
+    chunks = [(path, start, end, stage, stage_args, depth, prefilter)
+              for start, end in split_file(path, jobs * PARALLEL_CHUNKS_PER_JOB)]
+
+    with multiprocessing.Pool(jobs) as pool:
+        # imap preserves the order of the ranges.
+        for offsets in pool.imap(_scan_chunk_args, chunks):
+            for offset in offsets:
+                reader.seek(offset)
+                yield reader.read_packet()
+
+    reader.close()
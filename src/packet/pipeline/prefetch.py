@@ -0,0 +1,124 @@
+"""
+prefetch: reads and decodes merge sources in worker processes.
+Each worker reads a group of captures, merges them, and sends the merged
+records to the merging process in PacketBatches through a bounded queue,
+so the merging process only orders and writes packets.
+"""
+
+import os
+import multiprocessing
+
+from ..common import PacketBatch
+from ..capfile.core import PACKET_BATCH_SIZE
+from ..capfile.detect import open_reader
+from .merge import merge, source_offsets
+from .cascade import read_start_times
+
+# Number of batches a worker may have queued ahead of the merging process.
+PREFETCH_QUEUE_DEPTH = 8
+
+
+def read_group(paths, offsets, queue, batch_size):
+    """
+    Worker function. Merges the captures at the given paths, adding the given
+    offset to each capture's packets, and puts the result on a queue in
+    PacketBatches of up to batch_size packets, followed by None.
+    If an exception is raised, it is put on the queue instead.
+    """
+    try:
+        streams = [open(path, "rb") for path in paths]
+        readers = [open_reader(stream) for stream in streams]
+
+        if len(readers) == 1:
+            # A single capture is read in batches, without Packet objects.
+            reader, offset = readers[0], offsets[0]
+            while True:
+                batch = reader.read_batch(batch_size)
+                if len(batch) == 0:
+                    break
+                if offset != 0:
+                    for i in range(len(batch)):
+                        batch.timestamps[i] += offset
+                queue.put(batch)
+        else:
+            batch = PacketBatch()
+            for packet in merge([reader.packets() for reader in readers], offsets=offsets):
+                batch.append_packet(packet)
+                if len(batch) >= batch_size:
+                    queue.put(batch)
+                    batch = PacketBatch()
+            if len(batch) > 0:
+                queue.put(batch)
+
+        for reader in readers:
+            reader.close()
+        queue.put(None)
+    except Exception as error:
+        queue.put(error)
+
+
+def queue_packets(queue):
+    """
+    Generator function producing the packets of the batches on a queue,
+    until None is received. Exceptions received are raised.
+    """
+    while True:
+        batch = queue.get()
+        if batch is None:
+            return
+        if isinstance(batch, Exception):
+            raise batch
+        yield from batch
+
+
+def split_groups(items, count):
+    """Splits a list into (at most) count contiguous groups of near equal size."""
+    count = max(1, min(count, len(items)))
+    size, extra = divmod(len(items), count)
+    groups = []
+    start = 0
+    for i in range(count):
+        end = start + size + (1 if i < extra else 0)
+        groups.append(items[start:end])
+        start = end
+    return groups
+
+
+def prefetch_merge(paths, relative=True, offset=None, jobs=None,
+                   batch_size=PACKET_BATCH_SIZE, depth=PREFETCH_QUEUE_DEPTH):
+    """
+    Generator function that merges the captures at the given paths,
+    producing the same packets as pipeline.merge.merge would.
+    relative and offset have the same meaning as for merge.
+    Captures are read in 'jobs' worker processes (Default is the number of
+    CPUs, at most one per capture), each merging a contiguous group of the
+    captures, and each having at most 'depth' batches queued at once.
+    """
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+
+    # Offsets are computed over all captures, so that every group is shifted
+    # the same way as in a single merge. Empty captures are left out.
+    offsets = source_offsets(read_start_times(paths), relative, offset)
+    sources = [(path, shift) for path, shift in zip(paths, offsets) if shift is not None]
+    if not sources:
+        return
+
+    workers = []
+    queues = []
+    for group in split_groups(sources, jobs):
+        queue = multiprocessing.Queue(depth)
+        worker = multiprocessing.Process(
+            target=read_group, daemon=True,
+            args=([path for path, shift in group], [shift for path, shift in group], queue, batch_size))
+        worker.start()
+        workers.append(worker)
+        queues.append(queue)
+
+    try:
+        # Groups are contiguous and in order, so ties break as in a single merge.
+        yield from merge([queue_packets(queue) for queue in queues], offsets=[0] * len(queues))
+    finally:
+        for worker in workers:
+            worker.terminate()
+            worker.join()
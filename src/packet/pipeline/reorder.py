@@ -0,0 +1,96 @@
+"""
+reorder: contains the reorder function, which repairs local disorder.
+Packets are held in a heap for a bounded time (or count), and released in
+time order once no older packet is expected to arrive.
+"""
+
+import heapq
+
+# Default time packets are held for, in nanoseconds (10 ms).
+REORDER_WINDOW = 10**7
+
+
+class ReorderStats:
+    """
+    Counters kept by reorder.
+     - packets: Packets read.
+     - reordered: Packets that arrived after a newer packet, put back in order.
+     - late: Packets that arrived after a newer packet had been released,
+       which could not be put back in order.
+     - dropped: Late packets that were discarded.
+     - max_delay: Largest time, in nanoseconds, by which a packet arrived
+       after a newer packet. A window at least this long orders every packet.
+    """
+    __slots__ = {"packets", "reordered", "late", "dropped", "max_delay"}
+
+    def __init__(self):
+        self.packets = 0
+        self.reordered = 0
+        self.late = 0
+        self.dropped = 0
+        self.max_delay = 0
+
+    def __str__(self):
+        return "Packets: {0}, Reordered: {1}, Late: {2}, Dropped: {3}, Max delay: {4}ns".format(
+            self.packets, self.reordered, self.late, self.dropped, self.max_delay)
+
+
+def reorder(source, window=REORDER_WINDOW, count=None, drop_late=False, stats=None, compact=False):
+    """
+    Generator function that produces the packets from source in time order,
+    provided no packet is more than the bound out of place.
+    A packet is held until one at least 'window' nanoseconds newer is read,
+    or until more than 'count' packets are held, whichever comes first.
+    Either bound may be None, but not both.
+    Packets older than one already produced are 'late'; they are produced
+    immediately, or discarded if drop_late is true.
+    If stats is a ReorderStats object, it is updated as packets are read.
+    Packets with equal times are produced in the order they were read.
+    If compact is true, identified packets keep their identity in compact
+    form (see Packet.compact) while they are held.
+    """
+    if window is None and count is None:
+        raise ValueError("reorder needs a window or count bound.")
+    if stats is None:
+        stats = ReorderStats()
+
+    # Heap of (time, sequence number, packet) entries.
+    # The sequence number keeps equal times in order.
+    heap = []
+    sequence = 0
+    newest = None
+    released = None
+
+    for packet in source:
+        timestamp = packet.timestamp
+        stats.packets += 1
+
+        if newest is None or timestamp >= newest:
+            newest = timestamp
+        else:
+            stats.max_delay = max(stats.max_delay, newest - timestamp)
+            if released is not None and timestamp < released:
+                # Too late to be put in order.
+                stats.late += 1
+                if drop_late:
+                    stats.dropped += 1
+                else:
+                    yield packet
+                continue
+            stats.reordered += 1
+
+        if compact:
+            packet.compact()
+        heapq.heappush(heap, (timestamp, sequence, packet))
+        sequence += 1
+
+        # Release packets old enough that nothing older should follow,
+        # and packets over the count bound.
+        while heap and ((window is not None and newest - heap[0][0] >= window) or
+                        (count is not None and len(heap) > count)):
+            released, _, oldest = heapq.heappop(heap)
+            yield oldest
+
+    while heap:
+        released, _, oldest = heapq.heappop(heap)
+        yield oldest
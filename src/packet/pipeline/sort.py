@@ -0,0 +1,75 @@
+"""
+sort: contains the sort function, an external merge sort for captures
+larger than memory.
+Packets are collected into runs bounded by a memory budget, each run is
+sorted and written to a temporary file, and the runs are then merged.
+"""
+
+import os
+import tempfile
+
+from ..common import PacketBatch
+from ..capfile import pcapng
+from .cascade import cascade_merge, CASCADE_FD_BUDGET, CASCADE_SNAPLEN
+
+# Default memory used for a run, in bytes.
+SORT_MEMORY_BUDGET = 256 * 2**20
+
+# Approximate memory used per packet in a run, besides its data:
+# the batch's field arrays, and an entry in the sort order.
+SORT_PACKET_OVERHEAD = 40 + 8
+
+
+def sorted_batch(batch):
+    """Generator function producing the packets of a batch in time order."""
+    timestamps = batch.timestamps
+    # sorted is stable, so packets with equal times keep their order.
+    for idx in sorted(range(len(batch)), key=timestamps.__getitem__):
+        yield batch[idx]
+
+
+def write_run(batch, workdir, number):
+    """Writes the packets of a batch in time order to a run file, returning its path."""
+    path = os.path.join(workdir, "run-{0}.pcapng".format(number))
+    destination = pcapng.PcapngWriter(open(path, "wb"), tsresol=9, snaplen=CASCADE_SNAPLEN)
+    destination.write_packets(sorted_batch(batch))
+    destination.close()
+    return path
+
+
+def sort(source, memory=SORT_MEMORY_BUDGET, tmpdir=None, fd_budget=CASCADE_FD_BUDGET):
+    """
+    Generator function that produces the packets from source in time order.
+    Packets with equal times are produced in the order they were read.
+    Packets are copied into runs using about 'memory' bytes at most; if the
+    source does not fit in one run, runs are written as nanosecond pcapng
+    files in a temporary directory under tmpdir (Default is the system
+    temporary directory) and merged, with at most fd_budget files open.
+    The temporary directory is removed once the generator finishes or is closed.
+    """
+    batch = PacketBatch()
+    size = 0
+
+    with tempfile.TemporaryDirectory(prefix="pcpapu-sort-", dir=tmpdir) as workdir:
+        runs = []
+        for packet in source:
+            batch.append_packet(packet)
+            size += len(packet.data) + SORT_PACKET_OVERHEAD
+
+            if size >= memory:
+                runs.append(write_run(batch, workdir, len(runs)))
+
+                batch = PacketBatch()
+                size = 0
+
+        if not runs:
+            # Everything fit in memory.
+            yield from sorted_batch(batch)
+            return
+
+        if len(batch) > 0:
+            runs.append(write_run(batch, workdir, len(runs)))
+        batch = None
+
+        # Runs are in input order and ties break by run, so the merge is stable.
+        yield from cascade_merge(runs, relative=False, offset=0, fd_budget=fd_budget, tmpdir=workdir)
@@ -0,0 +1,117 @@
+"""
+radix: address prefix sets, as a path compressed binary (Patricia) trie.
+Membership of an address is decided in one walk from the root, visiting at
+most one node per address bit, however many prefixes are in the set.
+"""
+
+
+class PrefixNode:
+    """
+    Node of a PrefixSet trie.
+     - key: The first 'length' bits of the addresses below this node, as an int.
+     - length: Number of bits in key.
+     - terminal: True if key is a prefix in the set, so every address
+                 below this node is in the set.
+     - children: Two nodes (or None), for the addresses continuing with 0 and 1.
+    """
+    __slots__ = {"key", "length", "terminal", "children"}
+
+    def __init__(self, key, length, terminal):
+        self.key = key
+        self.length = length
+        self.terminal = terminal
+        self.children = [None, None]
+
+
+class PrefixSet:
+    """
+    A set of address prefixes, all of 'width' bits (32 for IPv4, 128 for IPv6).
+    Addresses and prefixes are given as big-endian bytes.
+    'address in prefix_set' is True if any prefix in the set covers address.
+    Nodes are only kept where prefixes diverge, and prefixes covered by
+    shorter ones are dropped, so the trie stays small.
+    """
+    __slots__ = {"width", "root", "size"}
+
+    def __init__(self, width, prefixes=()):
+        self.width = width
+        self.root = None
+        self.size = 0
+        for address, length in prefixes:
+            self.add(address, length)
+
+    def __len__(self):
+        """Returns the number of prefixes added."""
+        return self.size
+
+    def add(self, address, length=None):
+        """
+        Adds the prefix of the first 'length' bits of address (all of them
+        if length is None). Raises ValueError for a bad address or length.
+        """
+        if len(address) * 8 != self.width:
+            raise ValueError("Address is not {0} bits.".format(self.width))
+        if length is None:
+            length = self.width
+        if not 0 <= length <= self.width:
+            raise ValueError("Prefix length {0} out of range.".format(length))
+
+        key = int.from_bytes(address, "big") >> (self.width - length)
+        self.size += 1
+
+        parent = None
+        side = 0
+        node = self.root
+        while node is not None:
+            # Number of leading bits node and the prefix have in common.
+            shortest = min(node.length, length)
+            diff = (node.key >> (node.length - shortest)) ^ (key >> (length - shortest))
+            common = shortest - diff.bit_length()
+
+            if common < node.length:
+                if common == length:
+                    # The prefix covers the node, which is no longer needed.
+                    new = PrefixNode(key, length, True)
+                else:
+                    # The prefix diverges from the node, split it.
+                    new = PrefixNode(node.key >> (node.length - common), common, False)
+                    new.children[(node.key >> (node.length - common - 1)) & 1] = node
+                    new.children[(key >> (length - common - 1)) & 1] = PrefixNode(key, length, True)
+                break
+
+            # The node is a prefix of the new prefix.
+            if node.terminal:
+                # Already covered.
+                return
+            if length == node.length:
+                node.terminal = True
+                node.children = [None, None]
+                return
+
+            parent = node
+            side = (key >> (length - node.length - 1)) & 1
+            node = node.children[side]
+        else:
+            new = PrefixNode(key, length, True)
+
+        if parent is None:
+            self.root = new
+        else:
+            parent.children[side] = new
+
+    def __contains__(self, address):
+        """Returns True if a prefix in the set covers address (bytes)."""
+        if len(address) * 8 != self.width:
+            return False
+
+        width = self.width
+        address = int.from_bytes(address, "big")
+        node = self.root
+        while node is not None:
+            length = node.length
+            if address >> (width - length) != node.key:
+                return False
+            if node.terminal:
+                return True
+            node = node.children[(address >> (width - length - 1)) & 1]
+        return False